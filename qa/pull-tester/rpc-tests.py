@@ -0,0 +1,195 @@
+#!/usr/bin/env python2
+# Copyright (c) 2014 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+
+#
+# Parallel runner for the RPC tests listed in rpc-tests.sh.
+#
+# Takes the same arguments as rpc-tests.sh (an optional test name or
+# -extended, other options are passed on to every test), plus -jN to set
+# the number of tests run at once (default: number of CPUs).
+#
+# Every worker has its own PORT_SEED, so tests running at the same time use
+# disjoint port ranges (see p2p_port/rpc_port in test_framework/util.py),
+# and its own --tmpdir. Tests are started longest first, according to the
+# durations recorded by previous runs in rpc-tests-timings.json.
+#
+
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+TIMINGS_FILE = "rpc-tests-timings.json"
+EXTENDED_ARG = "-extended"
+# PORT_SEEDs 0 to 123 keep the p2p ports (11000 + 8 * seed + n) of every
+# worker below the rpc ports of worker 0 (12000 + n)
+MAX_JOBS = 124
+
+
+def read_test_lists():
+    """Return (testScripts, testScriptsExt) as listed in rpc-tests.sh."""
+    with open(os.path.join(CURDIR, "rpc-tests.sh")) as f:
+        script = f.read()
+    lists = []
+    for name in ("testScripts", "testScriptsExt"):
+        body = re.search(r"^%s=\((.*?)^\);" % name, script, re.M | re.S).group(1)
+        # Skip commented out entries
+        lines = [ line.split("#", 1)[0] for line in body.splitlines() ]
+        lists.append(re.findall(r"'([^']+)'", "\n".join(lines)))
+    return lists
+
+
+def read_config():
+    """Return the variables set by tests-config.sh."""
+    output = subprocess.check_output(
+        ["bash", "-c", 'set -a && . "$0/tests-config.sh" && env', CURDIR])
+    return dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+
+
+def load_timings(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_timings(path, timings):
+    with open(path + ".tmp", "w") as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def run_test(test, command, seed, tmpdir, env):
+    """Run one test script, returning (passed, duration, output)."""
+    env = dict(env)
+    env["PORT_SEED"] = str(seed)
+    testdir = tempfile.mkdtemp(prefix=re.sub(r"\W", "_", test) + ".", dir=tmpdir)
+    start = time.time()
+    process = subprocess.Popen(command + ["--tmpdir=" + os.path.join(testdir, "test")],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output = process.communicate()[0]
+    duration = time.time() - start
+    shutil.rmtree(testdir, ignore_errors=True)
+    return (process.returncode == 0, duration, output)
+
+
+def main():
+    args = sys.argv[1:]
+    jobs = multiprocessing.cpu_count()
+    for arg in list(args):
+        if re.match(r"^-j\d+$", arg):
+            jobs = int(arg[2:])
+            args.remove(arg)
+    if jobs > MAX_JOBS:
+        print "Running at most %d tests at once (asked for %d): their ports would overlap" % (MAX_JOBS, jobs)
+        jobs = MAX_JOBS
+
+    config = read_config()
+    if config.get("ENABLE_BITCOIND") != "1" or config.get("ENABLE_UTILS") != "1" \
+            or config.get("ENABLE_WALLET") != "1":
+        print "No rpc tests to run. Wallet, utils, and bitcoind must all be enabled"
+        return 0
+
+    (test_scripts, test_scripts_ext) = read_test_lists()
+    if config.get("ENABLE_ZMQ") == "1":
+        test_scripts.append("zmq_test.py")
+    if config.get("ENABLE_PROTON") == "1":
+        test_scripts.append("proton_test.py")
+
+    first = args[0] if args else ""
+    pass_on = [ arg for arg in args if arg != EXTENDED_ARG ]
+    tests = []
+    for test in test_scripts:
+        if not first or first.startswith("-") or test in (first, first + ".py"):
+            tests.append(test)
+    for test in test_scripts_ext:
+        if first == EXTENDED_ARG or test in (first, first + ".py"):
+            tests.append(test)
+    if first and not first.startswith("-"):
+        # The test name was for us, not for the test scripts
+        pass_on = pass_on[1:]
+
+    builddir = config["BUILDDIR"]
+    env = dict(os.environ)
+    env["BITCOINCLI"] = os.path.join(builddir, "qa", "pull-tester", "run-bitcoin-cli")
+    env["BITCOIND"] = config["REAL_BITCOIND"]
+
+    timings_path = os.path.join(builddir, "qa", "pull-tester", TIMINGS_FILE)
+    timings = load_timings(timings_path)
+    # Longest first, so a slow test doesn't start last and hold up the run.
+    # Tests never timed before go first as well.
+    tests.sort(key=lambda test: -timings.get(test, float("inf")))
+
+    tmpdir = tempfile.mkdtemp(prefix="rpc-tests.")
+    seeds = Queue()
+    for seed in range(jobs):
+        seeds.put(seed)
+    results = {}
+    lock = threading.Lock()
+
+    def worker(test):
+        seed = seeds.get()
+        try:
+            # Test names may carry arguments, e.g. 'txn_doublespend.py --mineblock'
+            words = test.split()
+            command = [ os.path.join(builddir, "qa", "rpc-tests", words[0]) ] + words[1:] + \
+                      [ "--srcdir", os.path.join(builddir, "src") ] + pass_on
+            (passed, duration, output) = run_test(test, command, seed, tmpdir, env)
+        except Exception as e:
+            (passed, duration, output) = (False, 0, "could not run %s: %s" % (test, e))
+        finally:
+            seeds.put(seed)
+        with lock:
+            results[test] = (passed, duration)
+            if passed:
+                print "--- Success: %s (%ds) ---" % (test, duration)
+            else:
+                print "!!! FAIL: %s (%ds) !!!" % (test, duration)
+                print output
+            sys.stdout.flush()
+
+    print "Running %d tests, %d at a time" % (len(tests), jobs)
+    start = time.time()
+    pool = ThreadPool(jobs)
+    pool.map(worker, tests, chunksize=1)
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for (test, (passed, duration)) in results.items():
+        if passed:
+            timings[test] = round(duration, 1)
+    save_timings(timings_path, timings)
+
+    failures = [ test for test in tests if not results[test][0] ]
+    print
+    print "%-45s %10s  %s" % ("TEST", "DURATION", "STATUS")
+    for test in sorted(tests, key=lambda test: -results[test][1]):
+        (passed, duration) = results[test]
+        print "%-45s %9ds  %s" % (test, duration, "Passed" if passed else "Failed")
+    print
+    print "Tests completed: %d in %ds (%ds of test time)" % \
+        (len(tests), elapsed, sum(duration for (_, duration) in results.values()))
+    print "successes %d; failures: %d" % (len(tests) - len(failures), len(failures))
+    if failures:
+        print
+        print "Failing tests: %s" % " ".join(failures)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
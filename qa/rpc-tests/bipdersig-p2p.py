@@ -37,7 +37,7 @@ class BIP66Test(ComparisonTestFramework):
         self.is_network_split = False
 
     def run_test(self):
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, self.options.pipeline_window)
         test.add_all_connections(self.nodes)
         NetworkThread().start() # Start up network handling in another thread
         test.run()
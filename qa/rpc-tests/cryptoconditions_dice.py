@@ -183,19 +183,7 @@ class CryptoconditionsDiceTest(CryptoconditionsTestFramework):
         # assert_equal(round(fundbalanceguess),round(float(fundinfoactual['funding'])))
 
     def run_test(self):
-        print("Mining blocks...")
-        rpc = self.nodes[0]
-        rpc1 = self.nodes[1]
-        # utxos from block 1 become mature in block 101
-        if not self.options.noshutdown:
-            rpc.generate(101)
-        self.sync_all()
-        rpc.getinfo()
-        rpc1.getinfo()
-        # this corresponds to -pubkey above
-        print("Importing privkeys")
-        rpc.importprivkey(self.privkey)
-        rpc1.importprivkey(self.privkey1)
+        self.setup_funded_chain()
         self.run_dice_tests()
 
 
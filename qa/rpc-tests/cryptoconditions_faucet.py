@@ -96,18 +96,8 @@ class CryptoconditionsFaucetTest(CryptoconditionsTestFramework):
         self.sync_all()
 
     def run_test(self):
-        print("Mining blocks...")
-        rpc = self.nodes[0]
-        rpc1 = self.nodes[1]
-        # utxos from block 1 become mature in block 101
-        rpc.generate(101)
-        self.sync_all()
-        rpc.getinfo()
-        rpc1.getinfo()
-        # this corresponds to -pubkey above
-        print("Importing privkeys")
-        rpc.importprivkey(self.privkey)
-        rpc1.importprivkey(self.privkey1)
+        # Always funds the chain: cc-tests.sh runs faucet first
+        self.setup_funded_chain(always_mine=True)
         self.run_faucet_tests()
 
 
@@ -156,19 +156,7 @@ class CryptoconditionsHeirTest(CryptoconditionsTestFramework):
         assert_equal(result["available"], "0")
 
     def run_test(self):
-        print("Mining blocks...")
-        rpc = self.nodes[0]
-        rpc1 = self.nodes[1]
-        # utxos from block 1 become mature in block 101
-        if not self.options.noshutdown:
-            rpc.generate(101)
-        self.sync_all()
-        rpc.getinfo()
-        rpc1.getinfo()
-        # this corresponds to -pubkey above
-        print("Importing privkeys")
-        rpc.importprivkey(self.privkey)
-        rpc1.importprivkey(self.privkey1)
+        self.setup_funded_chain()
         self.run_heir_tests()
 
 
@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+#
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+#
+
+#
+# Micro-benchmarks for the python test framework itself.  These do not need
+# a running komodod; they exercise the client-side code paths (serialization,
+# P2P framing, ...) on synthetic data.
+#
+# Usage: framework_bench.py [options] [benchmark ...]
+#
+
+import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
+
+import cStringIO
+import decimal
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+from collections import deque
+
+from test_framework.mininode import CBlock, CBlockHeader, CBlockLocator, CTransaction, CTxIn, CTxOut, \
+    COutPoint, OutputDescription, SpendDescription, deser_from_buffer, \
+    CInv, NodeConn, NodeConnCB, msg_block, msg_inv, hash256, SAPLING_BRANCH_ID
+from test_framework.authproxy import EncodeDecimal, decode_response, _fast_loads
+from test_framework.equihash import gbp_basic, gbp_vectorized, zcash_person, \
+    hash_nonce, gbp_validate, gbp_validate_batch
+from test_framework import equihash
+from test_framework.script import CScript, CScriptOp, CScriptInvalidError, SigHashCache, \
+    SignatureHash, FindAndDelete, GetBlockSigOpCount, SIGHASH_ALL, SIGHASH_SINGLE, \
+    SIGHASH_ANYONECANPAY, OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG, OP_CHECKSIGVERIFY, \
+    OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY, OP_CODESEPARATOR, OP_PUSHDATA1, OP_PUSHDATA2, \
+    OP_PUSHDATA4
+from pyblake2 import blake2b
+
+
+def random_bytes(n):
+    return "".join(chr(random.getrandbits(8)) for _ in xrange(n))
+
+
+def make_transaction(n_in, n_out, n_shielded):
+    tx = CTransaction()
+    for i in xrange(n_in):
+        tx.vin.append(CTxIn(COutPoint(random.getrandbits(256), i),
+                            random_bytes(107), 0xffffffff))
+    for i in xrange(n_out):
+        tx.vout.append(CTxOut(random.randint(0, 10**8), random_bytes(25)))
+    if n_shielded:
+        for i in xrange(n_shielded):
+            spend = SpendDescription()
+            spend.cv = random.getrandbits(256)
+            spend.anchor = random.getrandbits(256)
+            spend.nullifier = random.getrandbits(256)
+            spend.rk = random.getrandbits(256)
+            spend.zkproof = random_bytes(192)
+            spend.spendAuthSig = random_bytes(64)
+            tx.shieldedSpends.append(spend)
+            output = OutputDescription()
+            output.cv = random.getrandbits(256)
+            output.cmu = random.getrandbits(256)
+            output.ephemeralKey = random.getrandbits(256)
+            output.encCiphertext = random_bytes(580)
+            output.outCiphertext = random_bytes(80)
+            output.zkproof = random_bytes(192)
+            tx.shieldedOutputs.append(output)
+        tx.bindingSig = random_bytes(64)
+    return tx
+
+
+def make_block(n_tx):
+    block = CBlock()
+    block.hashPrevBlock = random.getrandbits(256)
+    block.nTime = int(time.time())
+    block.nBits = 0x200f0f0f
+    block.nNonce = random.getrandbits(256)
+    block.nSolution = [random.getrandbits(8) for _ in xrange(1344)]
+    for i in xrange(n_tx):
+        block.vtx.append(make_transaction(2, 2, 1 if i % 4 == 0 else 0))
+    block.hashMerkleRoot = block.calc_merkle_root()
+    return block
+
+
+def random_hex(n):
+    return "%0*x" % (2 * n, random.getrandbits(8 * n))
+
+
+def random_amount():
+    return "%d.%08d" % (random.randint(0, 1000), random.randint(0, 10**8 - 1))
+
+
+def make_getblock_response(n_tx):
+    """Body of a synthetic getblock verbosity 2 response, as sent by the node."""
+    txs = []
+    for i in xrange(n_tx):
+        vin = '{"txid": "%s", "vout": 0, "scriptSig": {"asm": "...", "hex": "%s"}, ' \
+              '"value": %s, "sequence": 4294967295}' % \
+              (random_hex(32), random_hex(107), random_amount())
+        vout = ", ".join('{"value": %s, "n": %d, "scriptPubKey": {"asm": "...", "hex": "%s", '
+                         '"reqSigs": 1, "type": "pubkeyhash", "addresses": ["%s"]}}' %
+                         (random_amount(), n, random_hex(25), random_hex(17)) for n in xrange(2))
+        txs.append('{"txid": "%s", "version": 4, "locktime": 0, "size": 250, "vin": [%s], '
+                   '"vout": [%s], "vjoinsplit": []}' % (random_hex(32), vin, vout))
+    return '{"result": {"hash": "%s", "height": 1000, "difficulty": 1.000001, "tx": [%s]}, ' \
+           '"error": null, "id": 1}' % (random_hex(32), ", ".join(txs))
+
+
+def make_rawmempool_response(n_tx):
+    """Body of a synthetic getrawmempool true response."""
+    entries = ", ".join('"%s": {"size": 250, "fee": %s, "time": 1500000000, "height": 1000, '
+                        '"startingpriority": %s, "currentpriority": %s, "depends": []}' %
+                        (random_hex(32), random_amount(), random_amount(), random_amount())
+                        for _ in xrange(n_tx))
+    return '{"result": {%s}, "error": null, "id": 1}' % entries
+
+
+def frame_message(message, net="regtest"):
+    data = message.serialize()
+    r = NodeConn.MAGIC_BYTES[net]
+    r += message.command + "\x00" * (12 - len(message.command))
+    r += struct.pack("<I", len(data))
+    r += hash256(data)[:4]
+    r += data
+    return r
+
+
+class CountingCallback(NodeConnCB):
+    def __init__(self):
+        NodeConnCB.__init__(self)
+        self.count = 0
+
+    def deliver(self, conn, message):
+        self.count += 1
+
+
+class FeedNodeConn(NodeConn):
+    """A NodeConn without a socket, fed raw bytes through feed()."""
+    def __init__(self, callback):
+        # Only the framing state of NodeConn.__init__ is needed here.
+        self.log = logging.getLogger("FeedNodeConn")
+        self.sendqueue = deque()
+        self.sendoffset = 0
+        self.recvbuf = bytearray()
+        self.recvpos = 0
+        self.ver_send = 209
+        self.ver_recv = 209
+        self.last_sent = time.time()
+        self.state = "closed"
+        self.network = "regtest"
+        self.cb = callback
+        self.disconnect = False
+
+    def feed(self, data, chunk_size):
+        for i in xrange(0, len(data), chunk_size):
+            self.recvbuf += data[i:i+chunk_size]
+            self.got_data()
+
+
+def timed(func, count):
+    start = time.time()
+    for _ in xrange(count):
+        func()
+    return count / (time.time() - start)
+
+
+def report(name, unit, before, after):
+    print "%-12s %10.1f %s/s -> %10.1f %s/s (%.2fx)" % \
+        (name, before, unit, after, unit, after / before)
+
+
+def bench_deser(options):
+    '''Deserialize a stream of blocks via the file and buffer paths.'''
+    blocks = [make_block(options.txs).serialize() for _ in xrange(options.blocks)]
+
+    def stream_file():
+        for raw in blocks:
+            CBlock().deserialize(cStringIO.StringIO(raw))
+
+    def stream_buffer():
+        for raw in blocks:
+            deser_from_buffer(CBlock, raw)
+
+    # Both paths must agree before timing means anything.
+    for raw in blocks:
+        assert deser_from_buffer(CBlock, memoryview(raw)).serialize() == raw
+
+    before = timed(stream_file, options.rounds) * len(blocks)
+    after = timed(stream_buffer, options.rounds) * len(blocks)
+    report("deser", "blocks", before, after)
+
+
+def bench_framing(options):
+    '''Feed synthetic P2P streams through NodeConn.got_data.'''
+    def run(stream, expected):
+        cb = CountingCallback()
+        start = time.time()
+        FeedNodeConn(cb).feed(stream, NodeConn.read_size)
+        elapsed = time.time() - start
+        assert cb.count == expected
+        return elapsed
+
+    # Framing is linear if doubling the burst doubles the time taken.
+    n = options.messages
+    inv = frame_message(msg_inv([CInv(1, random.getrandbits(256))]))
+    small = run(inv * n, n)
+    double = run(inv * (2 * n), 2 * n)
+    print "%-12s %d inv msgs: %10.1f msgs/s, %d inv msgs: %10.1f msgs/s" % \
+        ("framing", n, n / small, 2 * n, 2 * n / double)
+
+    block = make_block(options.txs)
+    while len(block.serialize()) < 2000000:
+        block.vtx.extend(make_block(options.txs).vtx)
+    stream = frame_message(msg_block(block))
+    elapsed = run(stream, 1)
+    print "%-12s %.1f MB block: %.1f ms" % \
+        ("framing", len(stream) / 1e6, elapsed * 1000)
+
+
+def bench_rpcjson(options):
+    '''Decode large synthetic JSON-RPC responses.'''
+    def old_decode(data):
+        # What AuthServiceProxy._get_response did before, including the
+        # re-serialization for the debug log that ran even with logging off.
+        response = json.loads(data.decode('utf8'), parse_float=decimal.Decimal)
+        json.dumps(response["result"], default=EncodeDecimal)
+        return response
+
+    n = options.blocks * options.txs
+    for (name, data) in (("getblock", make_getblock_response(n)),
+                         ("rawmempool", make_rawmempool_response(n))):
+        assert old_decode(data) == decode_response(data)
+        before = timed(lambda: old_decode(data), options.rounds) * len(data) / 1e6
+        after = timed(lambda: decode_response(data), options.rounds) * len(data) / 1e6
+        report(name, "MB", before, after)
+        if _fast_loads is not None:
+            fast = timed(lambda: decode_response(data, False), options.rounds) * len(data) / 1e6
+            report(name + "/float", "MB", before, fast)
+
+
+def bench_blockstore(options):
+    '''Build locators, serve getheaders and getdata from a long chain in a BlockStore.'''
+    try:
+        from test_framework.blockstore import BlockStore
+    except ImportError as e:
+        # blockstore needs dbm, which not every python build has
+        print "%-12s skipped: %s" % ("blockstore", e)
+        return
+
+    def old_get(blockhash):
+        # What BlockStore.get did before: read and deserialize every time
+        block = CBlock()
+        block.deserialize(cStringIO.StringIO(store.blockDB[repr(blockhash)]))
+        block.calc_sha256()
+        return block
+
+    def old_get_locator(tip):
+        # BlockStore.get_locator, walking the chain with whole blocks
+        r = []
+        counter = 0
+        step = 1
+        last = old_get(tip)
+        while last is not None:
+            r.append(last.hashPrevBlock)
+            for i in range(step):
+                if repr(last.hashPrevBlock) not in store.blockDB:
+                    last = None
+                    break
+                last = old_get(last.hashPrevBlock)
+            counter += 1
+            if counter > 10:
+                step *= 2
+        locator = CBlockLocator()
+        locator.vHave = r
+        return locator
+
+    def old_headers_for(locator, tip):
+        headers = [ CBlockHeader(old_get(tip)) ]
+        while headers[0].sha256 not in locator.vHave:
+            if repr(headers[0].hashPrevBlock) not in store.blockDB:
+                break
+            headers.insert(0, CBlockHeader(old_get(headers[0].hashPrevBlock)))
+        return headers[:2000]
+
+    datadir = tempfile.mkdtemp(prefix="blockstore_bench")
+    try:
+        store = BlockStore(datadir)
+        # The blocks share their transactions; only the chain matters here
+        template = make_block(options.txs // 20 or 1)
+        hashes = []
+        prev = 0
+        for i in xrange(options.chain):
+            block = CBlock(template)
+            block.vtx = template.vtx
+            block.hashPrevBlock = prev
+            block.nNonce = i
+            store.add_block(block)
+            prev = block.sha256
+            hashes.append(prev)
+        tip = hashes[-1]
+
+        assert old_get_locator(tip).vHave == store.get_locator().vHave
+        before = timed(lambda: old_get_locator(tip), options.rounds)
+        after = timed(lambda: store.get_locator(), options.rounds)
+        report("locator", "locators", before, after)
+
+        # A peer 2000 blocks behind asks for headers
+        locator = store.get_locator(hashes[-min(2001, len(hashes))])
+        assert [h.sha256 for h in old_headers_for(locator, tip)] == \
+            [h.sha256 for h in store.headers_for(locator, 0).headers]
+        before = timed(lambda: old_headers_for(locator, tip), options.rounds)
+        after = timed(lambda: store.headers_for(locator, 0), options.rounds)
+        report("getheaders", "msgs", before, after)
+
+        # Peers fetching the most recent blocks over and over
+        recent = hashes[-16:]
+        inv = [CInv(2, h) for h in recent]
+        before = timed(lambda: [msg_block(old_get(h)) for h in recent], options.rounds * 10) * len(recent)
+        after = timed(lambda: store.get_blocks(inv), options.rounds * 10) * len(recent)
+        report("getdata", "blocks", before, after)
+        store.close()
+    finally:
+        shutil.rmtree(datadir)
+
+
+def bench_equihash(options):
+    '''Solve Equihash for the regtest (48,5) parameters.'''
+    if equihash.numpy is None:
+        print "%-12s skipped: gbp_vectorized needs numpy" % "equihash"
+        return
+    n, k = 48, 5
+    digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
+    digest.update(random_bytes(108))
+    digests = []
+    for nonce in xrange(options.blocks):
+        curr_digest = digest.copy()
+        hash_nonce(curr_digest, nonce)
+        digests.append(curr_digest)
+
+    # Same solutions, in the same order, or CBlock.solve would differ.
+    for curr_digest in digests:
+        assert gbp_basic(curr_digest, n, k) == gbp_vectorized(curr_digest, n, k)
+
+    def solve(solver):
+        for curr_digest in digests:
+            solver(curr_digest, n, k)
+
+    before = timed(lambda: solve(gbp_basic), options.rounds) * len(digests)
+    after = timed(lambda: solve(gbp_vectorized), options.rounds) * len(digests)
+    report("equihash", "solves", before, after)
+
+
+def bench_validate(options):
+    '''Validate the Equihash solutions of many (48,5) headers.'''
+    n, k = 48, 5
+    base = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
+    solved = []
+    for i in xrange(options.blocks):
+        block = make_block(0)
+        block.solve(n, k)
+        solved.append((block.equihash_input(), block.nSolution))
+    # Replayed headers: every solved one many times over
+    items = solved * (1000 // len(solved) + 1)
+
+    def one_by_one():
+        # What CBlock.is_valid does for each header
+        for (header, minimal) in items:
+            digest = base.copy()
+            digest.update(header)
+            assert gbp_validate(digest, minimal, n, k)
+
+    assert all(gbp_validate_batch(items, n, k))
+    before = timed(one_by_one, options.rounds) * len(items)
+    after = timed(lambda: gbp_validate_batch(items, n, k), options.rounds) * len(items)
+    report("validate", "hdrs", before, after)
+    processes = multiprocessing.cpu_count()
+    if processes > 1:
+        pooled = timed(lambda: gbp_validate_batch(items, n, k, processes), options.rounds) * len(items)
+        report("validate/%d" % processes, "hdrs", before, pooled)
+
+
+def bench_sighash(options):
+    '''Signature hashes of every input of a large transaction.'''
+    tx = make_transaction(options.inputs, 2, 0)
+    script = CScript([OP_DUP, OP_HASH160, random_bytes(20), OP_EQUALVERIFY, OP_CHECKSIG])
+    cache = SigHashCache(tx)
+    for hashtype in (SIGHASH_ALL, SIGHASH_SINGLE | SIGHASH_ANYONECANPAY):
+        for i in (0, 1, len(tx.vin) - 1):
+            assert cache.SignatureHash(script, i, hashtype) == SignatureHash(script, tx, i, hashtype)
+
+    def sign_uncached():
+        for i in xrange(len(tx.vin)):
+            SignatureHash(script, tx, i, SIGHASH_ALL)
+
+    def sign_cached():
+        cache = SigHashCache(tx)
+        for i in xrange(len(tx.vin)):
+            cache.SignatureHash(script, i, SIGHASH_ALL)
+
+    def sign_overwinter_uncached():
+        # hashPrevouts, hashSequence and hashOutputs recomputed per input
+        for i in xrange(len(tx.vin)):
+            SigHashCache(tx).OverwinterSignatureHash(script, i, SIGHASH_ALL, 0, SAPLING_BRANCH_ID)
+
+    def sign_overwinter():
+        cache = SigHashCache(tx)
+        for i in xrange(len(tx.vin)):
+            cache.OverwinterSignatureHash(script, i, SIGHASH_ALL, 0, SAPLING_BRANCH_ID)
+
+    # Uncached signing is quadratic, a single round is enough
+    before = timed(sign_uncached, 1) * len(tx.vin)
+    after = timed(sign_cached, options.rounds) * len(tx.vin)
+    report("sighash", "sigs", before, after)
+    before = timed(sign_overwinter_uncached, 1) * len(tx.vin)
+    after = timed(sign_overwinter, options.rounds) * len(tx.vin)
+    report("sighash/243", "sigs", before, after)
+
+
+def bench_script(options):
+    '''Parse, count sigops of and FindAndDelete the script_test.py vectors, and count block sigops.'''
+    try:
+        from script_test import ParseScript
+    except ImportError as e:
+        # script_test imports comptool, whose blockstore needs dbm
+        print "%-12s skipped: %s" % ("script", e)
+        return
+
+    def old_raw_iter(script):
+        # CScript.raw_iter before scripts were parsed once and cached
+        i = 0
+        while i < len(script):
+            sop_idx = i
+            opcode = ord(script[i])
+            i += 1
+            if opcode > OP_PUSHDATA4:
+                yield (opcode, None, sop_idx)
+                continue
+            if opcode < OP_PUSHDATA1:
+                datasize = opcode
+            elif opcode == OP_PUSHDATA1:
+                if i >= len(script):
+                    raise CScriptInvalidError('PUSHDATA1: missing data length')
+                datasize = ord(script[i])
+                i += 1
+            elif opcode == OP_PUSHDATA2:
+                if i + 1 >= len(script):
+                    raise CScriptInvalidError('PUSHDATA2: missing data length')
+                datasize = ord(script[i]) + (ord(script[i+1]) << 8)
+                i += 2
+            else:
+                if i + 3 >= len(script):
+                    raise CScriptInvalidError('PUSHDATA4: missing data length')
+                datasize = ord(script[i]) + (ord(script[i+1]) << 8) + (ord(script[i+2]) << 16) + (ord(script[i+3]) << 24)
+                i += 4
+            data = bytes(script[i:i+datasize])
+            if len(data) < datasize:
+                raise CScriptInvalidError('truncated data')
+            i += datasize
+            yield (opcode, data, sop_idx)
+
+    def old_sigops(script):
+        n = 0
+        try:
+            for (opcode, data, sop_idx) in old_raw_iter(script):
+                if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+                    n += 1
+                elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+                    n += 20
+        except CScriptInvalidError:
+            pass
+        return n
+
+    def old_find_and_delete(script, sig):
+        r = b''
+        last_sop_idx = sop_idx = 0
+        skip = True
+        for (opcode, data, sop_idx) in old_raw_iter(script):
+            if not skip:
+                r += script[last_sop_idx:sop_idx]
+            last_sop_idx = sop_idx
+            skip = script[sop_idx:sop_idx + len(sig)] == sig
+        if not skip:
+            r += script[last_sop_idx:]
+        return CScript(r)
+
+    # What a script test does with its scripts: iterate them raw and
+    # cooked, count their sigops and remove OP_CODESEPARATORs.
+    codesep = CScript([OP_CODESEPARATOR])
+
+    def old_consume(script):
+        try:
+            list(old_raw_iter(script))
+            [CScriptOp(opcode) if data is None else data for (opcode, data, _) in old_raw_iter(script)]
+            old_find_and_delete(script, codesep)
+        except CScriptInvalidError:
+            pass
+        old_sigops(script)
+
+    def consume(script):
+        try:
+            list(script.raw_iter())
+            list(script)
+            FindAndDelete(script, codesep)
+        except CScriptInvalidError:
+            pass
+        script.GetSigOpCount(False)
+
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "test", "data")
+    vectors = []
+    for name in ("script_valid.json", "script_invalid.json"):
+        with open(os.path.join(datadir, name)) as f:
+            for test in json.load(f):
+                if len(test) >= 3:
+                    vectors.append(bytes(ParseScript(test[0])))
+                    vectors.append(bytes(ParseScript(test[1])))
+    for script in vectors:
+        assert old_sigops(script) == CScript(script).GetSigOpCount(False)
+
+    # Fresh CScripts every round, so the parse is part of the measurement
+    before = timed(lambda: [old_consume(CScript(script)) for script in vectors],
+                   options.rounds) * len(vectors)
+    after = timed(lambda: [consume(CScript(script)) for script in vectors],
+                  options.rounds) * len(vectors)
+    report("script", "scripts", before, after)
+    # The same CScripts over and over, as when signing or repr()ing them
+    scripts = [CScript(script) for script in vectors]
+    before = timed(lambda: [old_consume(script) for script in scripts], options.rounds) * len(scripts)
+    after = timed(lambda: [consume(script) for script in scripts], options.rounds) * len(scripts)
+    report("script/reuse", "scripts", before, after)
+
+    blocks = [make_block(options.txs) for _ in xrange(options.blocks)]
+
+    def old_block_sigops(block):
+        return sum(old_sigops(script) for tx in block.vtx
+                   for script in [txin.scriptSig for txin in tx.vin] +
+                                 [txout.scriptPubKey for txout in tx.vout])
+
+    for block in blocks:
+        assert old_block_sigops(block) == GetBlockSigOpCount(block)
+    before = timed(lambda: [old_block_sigops(block) for block in blocks], options.rounds) * len(blocks)
+    after = timed(lambda: [GetBlockSigOpCount(block) for block in blocks], options.rounds) * len(blocks)
+    report("sigops", "blocks", before, after)
+
+
+BENCHMARKS = {
+    "blockstore": bench_blockstore,
+    "deser": bench_deser,
+    "equihash": bench_equihash,
+    "framing": bench_framing,
+    "rpcjson": bench_rpcjson,
+    "script": bench_script,
+    "sighash": bench_sighash,
+    "validate": bench_validate,
+}
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--blocks", dest="blocks", type="int", default=20,
+                      help="Number of synthetic blocks (default: %default)")
+    parser.add_option("--txs", dest="txs", type="int", default=200,
+                      help="Transactions per synthetic block (default: %default)")
+    parser.add_option("--chain", dest="chain", type="int", default=10000,
+                      help="Length of the chain in the blockstore benchmark (default: %default)")
+    parser.add_option("--inputs", dest="inputs", type="int", default=1000,
+                      help="Inputs of the transaction in the sighash benchmark (default: %default)")
+    parser.add_option("--messages", dest="messages", type="int", default=50000,
+                      help="Number of small P2P messages in a burst (default: %default)")
+    parser.add_option("--rounds", dest="rounds", type="int", default=3,
+                      help="Times to repeat each measurement (default: %default)")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="Random seed for synthetic data (default: %default)")
+    (options, args) = parser.parse_args()
+
+    names = args or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '%s' (choose from: %s)"
+                         % (name, ", ".join(sorted(BENCHMARKS))))
+    for name in names:
+        random.seed(options.seed)
+        BENCHMARKS[name](options)
+
+
+if __name__ == '__main__':
+    main()
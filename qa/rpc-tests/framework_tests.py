@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+#
+
+#
+# Self-tests for the python test framework.  Like framework_bench.py these do
+# not need a running komodod.
+#
+# Usage: framework_tests.py [unittest options]
+#
+
+import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
+
+import binascii
+import cStringIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_framework.mininode import CTransaction, CTxIn, CTxOut, COutPoint
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.script import CScript, SigHashCache, SIGHASH_SINGLE
+
+try:
+    from test_framework.blockstore import BlockStore
+except ImportError:
+    # blockstore needs dbm, which not every python build has
+    BlockStore = None
+
+
+class CTransactionTest(unittest.TestCase):
+
+    def make_tx(self):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(0x1234, 0), "\x51", 0xffffffff))
+        tx.vout.append(CTxOut(100000000, "\x51"))
+        return tx
+
+    def test_field_assignment_invalidates_hash(self):
+        tx = self.make_tx()
+        tx.calc_sha256()
+        old_sha256, old_hash = tx.sha256, tx.hash
+        tx.nLockTime += 1
+        tx.calc_sha256()
+        self.assertNotEqual(tx.sha256, old_sha256)
+        self.assertNotEqual(tx.hash, old_hash)
+        self.assertEqual(tx.hash, self.fresh_hash(tx))
+
+    def test_nested_change_needs_rehash(self):
+        tx = self.make_tx()
+        tx.calc_sha256()
+        old_hash = tx.hash
+        tx.vout[0].nValue -= 1
+        tx.rehash()
+        self.assertNotEqual(tx.hash, old_hash)
+        self.assertEqual(tx.hash, self.fresh_hash(tx))
+
+    def fresh_hash(self, tx):
+        copy = CTransaction(tx)
+        copy.calc_sha256()
+        return copy.hash
+
+
+sighash_file = "../../src/test/data/sighash.json"
+
+class SigHashTest(unittest.TestCase):
+
+    def test_vectors(self):
+        # The vectors komodod's sighash_tests check against, including the
+        # ZIP-143 (Overwinter) and ZIP-243 (Sapling) digests
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), sighash_file)
+        checked = {}
+        for raw, script, i, hashtype, branch_id, result in json.load(open(path))[1:]:
+            tx = CTransaction()
+            f = cStringIO.StringIO(binascii.unhexlify(raw))
+            try:
+                tx.deserialize(f)
+            except Exception:
+                # mininode cannot parse the JoinSplit proofs
+                continue
+            if f.read() != "" or tx.vJoinSplit:
+                continue
+            script = CScript(binascii.unhexlify(script))
+            if tx.fOverwintered:
+                digest = SigHashCache(tx).OverwinterSignatureHash(script, i, hashtype, 0, branch_id)
+            elif hashtype & 0x1f == SIGHASH_SINGLE and i >= len(tx.vout):
+                continue
+            else:
+                digest = SigHashCache(tx).SignatureHash(script, i, hashtype)[0]
+            self.assertEqual(digest[::-1].encode('hex_codec'), result, (raw, i, hashtype))
+            version = tx.nVersion if tx.fOverwintered else 1
+            checked[version] = checked.get(version, 0) + 1
+        # Legacy, Overwinter (v3) and Sapling (v4) vectors were all checked
+        self.assertEqual(sorted(checked), [1, 3, 4])
+
+
+@unittest.skipIf(BlockStore is None, "blockstore needs dbm")
+class BlockStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.store = BlockStore(self.datadir)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.datadir)
+
+    def add_block(self, prev, height):
+        block = create_block(prev, create_coinbase(height), height)
+        block.solve()
+        self.store.add_block(block)
+        return block
+
+    def test_get_returns_a_copy(self):
+        block = self.add_block(0x1234, 1)
+        got = self.store.get(block.sha256)
+        got.vtx = []
+        got.nTime += 1
+        again = self.store.get(block.sha256)
+        self.assertEqual(len(again.vtx), 1)
+        self.assertEqual(again.nTime, block.nTime)
+
+    def test_height(self):
+        orphan = self.add_block(0x1234, 1)
+        child = self.add_block(orphan.sha256, 2)
+        self.assertIsNone(self.store.get_height(orphan.sha256))
+        self.assertIsNone(self.store.get_height(child.sha256))
+        self.assertIsNone(self.store.get_height(0x5678))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+#
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+#
+
+#
+# Compares ways of mining blocks in tests, in blocks/s including the time
+# for a second node to sync them:
+#  - generate(1) and sync_blocks per block, as many tests do,
+#  - a single generate(N),
+#  - generate_blocks(): generate(1) calls in one batch request, one sync,
+#  - blocks built and solved client-side with BlockFactory, sent with
+#    submit_blocks(), solved with CBlock.solve and with a BlockMiner pool.
+#
+# This is a benchmark, not part of the regression test suite.
+#
+
+import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
+
+import time
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, initialize_chain_clean, \
+    start_nodes, connect_nodes_bi, sync_blocks, generate_blocks
+from test_framework.blocktools import BlockFactory, BlockMiner, submit_blocks
+
+
+class GenerateBench(BitcoinTestFramework):
+
+    def add_options(self, parser):
+        parser.add_option("--blocks", dest="blocks", type="int", default=20,
+                          help="Blocks to mine per method (default: %default)")
+
+    def setup_chain(self):
+        print("Initializing test directory "+self.options.tmpdir)
+        initialize_chain_clean(self.options.tmpdir, 2)
+
+    def setup_network(self, split=False):
+        self.nodes = start_nodes(2, self.options.tmpdir)
+        connect_nodes_bi(self.nodes, 0, 1)
+        self.is_network_split = False
+
+    def measure(self, name, mine):
+        n = self.options.blocks
+        height = self.nodes[0].getblockcount()
+        start = time.time()
+        mine(n)
+        elapsed = time.time() - start
+        assert_equal(self.nodes[1].getblockcount(), height + n)
+        print("%-20s %4d blocks in %6.2fs: %6.1f blocks/s" % (name, n, elapsed, n / elapsed))
+
+    def run_test(self):
+        node = self.nodes[0]
+
+        def generate_one_by_one(n):
+            for i in range(n):
+                node.generate(1)
+                sync_blocks(self.nodes)
+
+        def generate_n(n):
+            node.generate(n)
+            sync_blocks(self.nodes)
+
+        def client_side(n):
+            submit_blocks(node, BlockFactory.from_node(node).blocks(n))
+            sync_blocks(self.nodes)
+
+        def client_side_pool(n):
+            with BlockMiner() as miner:
+                submit_blocks(node, BlockFactory.from_node(node, miner).blocks(n))
+            sync_blocks(self.nodes)
+
+        self.measure("generate(1) + sync", generate_one_by_one)
+        self.measure("generate(N)", generate_n)
+        self.measure("generate_blocks", lambda n: generate_blocks(node, n, self.nodes))
+        self.measure("client-side", client_side)
+        self.measure("client-side/pool", client_side_pool)
+
+
+if __name__ == '__main__':
+    GenerateBench().main()
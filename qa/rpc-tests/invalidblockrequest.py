@@ -33,7 +33,7 @@ class InvalidBlockRequestTest(ComparisonTestFramework):
         self.num_nodes = 1
 
     def run_test(self):
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, self.options.pipeline_window)
         test.add_all_connections(self.nodes)
         self.tip = None
         self.block_time = None
@@ -10,8 +10,11 @@
 import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
 
 import string
+import cStringIO
+from binascii import unhexlify
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.authproxy import JSONRPCException
+from test_framework.mininode import CMerkleBlock, MerkleTree, check_merkle_branch
 from test_framework.util import assert_equal, assert_raises, \
     initialize_chain_clean, start_node, connect_nodes
 
@@ -67,6 +70,20 @@ class MerkleBlockTest(BitcoinTestFramework):
         assert_equal(self.nodes[2].verifytxoutproof(self.nodes[2].gettxoutproof([txid1, txid2])), txlist)
         assert_equal(self.nodes[2].verifytxoutproof(self.nodes[2].gettxoutproof([txid1, txid2], blockhash)), txlist)
 
+        # A proof built client-side from the block's txids must match the
+        # one served by the node, and each branch must lead to its root
+        tree = MerkleTree(int(txid, 16) for txid in blocktxn)
+        proof = CMerkleBlock()
+        proof.deserialize(cStringIO.StringIO(unhexlify(self.nodes[2].gettxoutproof([txid1, txid2]))))
+        assert_equal(proof.header.hashMerkleRoot, tree.root())
+        indices = [blocktxn.index(txid1), blocktxn.index(txid2)]
+        assert_equal(proof.txn.serialize(), tree.partial_tree(indices).serialize())
+        (root, matches) = proof.txn.extract_matches()
+        assert_equal(root, tree.root())
+        assert_equal(sorted(i for (i, h) in matches), sorted(indices))
+        for i in indices:
+            assert_equal(check_merkle_branch(int(blocktxn[i], 16), tree.branch(i), i), root)
+
         txin_spent = self.nodes[1].listunspent(1).pop()
         tx3 = self.nodes[1].createrawtransaction([txin_spent], {self.nodes[0].getnewaddress(): 10})
         self.nodes[0].sendrawtransaction(self.nodes[1].signrawtransaction(tx3)["hex"])
@@ -81,17 +81,6 @@ class TestNode(NodeConnCB):
     def on_getdata(self, conn, message):
         self.last_getdata = message
 
-    # Spin until verack message is received from the node.
-    # We use this to signal that our test can begin. This
-    # is called from the testing thread, so it needs to acquire
-    # the global lock.
-    def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
-
     # Wrapper for the NodeConn's send_message function
     def send_message(self, message):
         self.connection.send_message(message)
@@ -102,14 +91,7 @@ class TestNode(NodeConnCB):
     # Sync up with the node after delivery of a block
     def sync_with_ping(self, timeout=30):
         self.connection.send_message(msg_ping(nonce=self.ping_counter))
-        received_pong = False
-        sleep_time = 0.05
-        while not received_pong and timeout > 0:
-            time.sleep(sleep_time)
-            timeout -= sleep_time
-            with mininode_lock:
-                if self.last_pong.nonce == self.ping_counter:
-                    received_pong = True
+        received_pong = self.wait_for_pong(self.ping_counter, timeout)
         self.ping_counter += 1
         return received_pong
 
@@ -148,8 +130,8 @@ class AcceptBlockTest(BitcoinTestFramework):
         NetworkThread().start() # Start up network handling in another thread
 
         # Test logic begins here
-        test_node.wait_for_verack()
-        white_node.wait_for_verack()
+        assert test_node.wait_for_verack(), "no verack from the node"
+        assert white_node.wait_for_verack(), "no verack from the node"
 
         # 1. Have both nodes mine a block (leave IBD)
         [ n.generate(1) for n in self.nodes ]
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+#
+
+#
+# P2P transaction load generator.
+#
+# Connects a number of mininode peers to an already running regtest node,
+# pre-builds one chain of anyone-can-spend transactions per peer (funded from
+# the node's wallet), then announces them at a configurable rate and reports:
+#  - how fast the node accepted them into its mempool,
+#  - how fast they reached the mempools of the nodes given with
+#    --relay-rpcurl, which should be peers of the node under test,
+#  - inv -> getdata latency percentiles (in --mode=inv),
+#  - any reject messages received.
+#
+# The outputs have an empty scriptPubKey and are spent with an OP_TRUE
+# scriptSig. Such transactions are not standard, so this only works on
+# regtest, which doesn't require standard transactions.
+#
+# This is not part of the regression test suite, e.g.:
+#   p2p_load_generator.py --rpcurl=http://rt:rt@127.0.0.1:12000 \
+#       --relay-rpcurl=http://rt:rt@127.0.0.1:12001 \
+#       --p2pport=11000 --peers=8 --txs=20000 --rate=500
+#
+
+import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
+
+from test_framework.authproxy import AuthServiceProxy
+from test_framework.blocktools import create_transaction
+from test_framework.mininode import CTransaction, CTxOut, CInv, NodeConn, \
+    NodeConnCB, NetworkThread, mininode_lock, msg_inv, msg_ping, msg_tx, \
+    COIN, wait_until
+from test_framework.script import CScript, OP_TRUE
+
+import cStringIO
+import optparse
+import time
+
+from binascii import hexlify, unhexlify
+from collections import defaultdict
+
+
+class LoadPeer(NodeConnCB):
+    def __init__(self):
+        NodeConnCB.__init__(self)
+        self.create_callback_map()
+        self.txs = {}
+        self.inv_sent = {}
+        self.getdata_latency = []
+        self.rejects = []
+        self.last_pong = None
+
+    # Answer getdata for our own transactions and time how long the node
+    # took to ask for them after the inv.
+    def on_getdata(self, conn, message):
+        now = time.time()
+        for i in message.inv:
+            if i.type == 1 and i.hash in self.txs:
+                sent = self.inv_sent.pop(i.hash, None)
+                if sent is not None:
+                    self.getdata_latency.append(now - sent)
+                conn.send_message(msg_tx(self.txs[i.hash]))
+
+    # Don't fetch the transactions the node relays from the other peers.
+    def on_inv(self, conn, message):
+        pass
+
+    def on_reject(self, conn, message):
+        self.rejects.append(message)
+
+    def on_pong(self, conn, message):
+        self.last_pong = message.nonce
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def fund_chains(rpc, peers, length, fee):
+    """Send one anyone-can-spend output per peer and return the funding tx."""
+    needed = peers * (length + 1) * fee + fee
+    utxos = sorted(rpc.listunspent(), key=lambda u: u['amount'], reverse=True)
+    if not utxos or int(utxos[0]['amount'] * COIN) < needed:
+        raise RuntimeError("need a single spendable output of at least %d zatoshis" % needed)
+    utxo = utxos[0]
+    rawtx = rpc.createrawtransaction([{"txid": utxo['txid'], "vout": utxo['vout']}],
+                                     {rpc.getnewaddress(): 1})
+    tx = CTransaction()
+    tx.deserialize(cStringIO.StringIO(unhexlify(rawtx)))
+    value = (int(utxo['amount'] * COIN) - fee) // peers
+    tx.vout = [CTxOut(value, "") for _ in xrange(peers)]
+    signresult = rpc.signrawtransaction(hexlify(tx.serialize()))
+    if not signresult['complete']:
+        raise RuntimeError("could not sign funding transaction")
+    tx.deserialize(cStringIO.StringIO(unhexlify(signresult['hex'])))
+    tx.rehash()
+    rpc.sendrawtransaction(signresult['hex'])
+    return tx
+
+
+def build_chain(funding, n, length, fee):
+    """Pre-build a chain of length transactions spending funding output n."""
+    chain = []
+    prevtx, prevn = funding, n
+    value = funding.vout[n].nValue
+    for _ in xrange(length):
+        value -= fee
+        tx = create_transaction(prevtx, prevn, CScript([OP_TRUE]), value)
+        chain.append(tx)
+        prevtx, prevn = tx, 0
+    return chain
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--rpcurl", dest="rpcurl", default="http://rt:rt@127.0.0.1:12000",
+                      help="RPC URL of the node under test (default: %default)")
+    parser.add_option("--relay-rpcurl", dest="relay_rpcurls", action="append", default=[],
+                      help="RPC URL of a peer of the node under test, to time how long the "
+                           "transactions take to reach its mempool (may be repeated)")
+    parser.add_option("--p2phost", dest="p2phost", default="127.0.0.1",
+                      help="P2P address of the node under test (default: %default)")
+    parser.add_option("--p2pport", dest="p2pport", type="int", default=11000,
+                      help="P2P port of the node under test (default: %default)")
+    parser.add_option("--net", dest="net", default="regtest",
+                      choices=sorted(NodeConn.MAGIC_BYTES),
+                      help="Network magic to use (default: %default)")
+    parser.add_option("--peers", dest="peers", type="int", default=4,
+                      help="Number of P2P connections (default: %default)")
+    parser.add_option("--txs", dest="txs", type="int", default=1000,
+                      help="Total number of transactions to send (default: %default)")
+    parser.add_option("--rate", dest="rate", type="float", default=0,
+                      help="Transactions per second to send, 0 for unlimited (default: %default)")
+    parser.add_option("--fee", dest="fee", type="int", default=10000,
+                      help="Fee per transaction in zatoshis (default: %default)")
+    parser.add_option("--mode", dest="mode", default="inv", choices=["inv", "tx"],
+                      help="Announce with inv and answer getdata, or push tx directly (default: %default)")
+    parser.add_option("--no-mine", dest="mine", default=True, action="store_false",
+                      help="Don't mine a block to confirm the funding transaction")
+    parser.add_option("--timeout", dest="timeout", type="float", default=300,
+                      help="Seconds to wait for the mempool to catch up (default: %default)")
+    (options, args) = parser.parse_args()
+
+    rpc = AuthServiceProxy(options.rpcurl)
+    relay_rpcs = [AuthServiceProxy(url) for url in options.relay_rpcurls]
+    length = (options.txs + options.peers - 1) // options.peers
+
+    print "Funding %d chains of %d transactions..." % (options.peers, length)
+    funding = fund_chains(rpc, options.peers, length, options.fee)
+    if options.mine:
+        rpc.generate(1)
+    chains = [build_chain(funding, n, length, options.fee) for n in xrange(options.peers)]
+
+    peers = []
+    connections = []
+    for chain in chains:
+        peer = LoadPeer()
+        for tx in chain:
+            peer.txs[tx.sha256] = tx
+        peers.append(peer)
+        connections.append(NodeConn(options.p2phost, options.p2pport, rpc, peer,
+                                    net=options.net))
+    NetworkThread().start()
+    if not wait_until(lambda: all(p.verack_received for p in peers), 30):
+        raise RuntimeError("not all peers completed the version handshake")
+
+    baseline = rpc.getmempoolinfo()['size']
+    total = options.peers * length
+    print "Sending %d transactions over %d connections..." % (total, options.peers)
+
+    # Interleave the chains so every connection is kept busy, and pace the
+    # sends against the start time rather than sleeping a fixed interval.
+    start = time.time()
+    sent = 0
+    for j in xrange(length):
+        for (conn, peer, chain) in zip(connections, peers, chains):
+            tx = chain[j]
+            if options.mode == "inv":
+                with mininode_lock:
+                    peer.inv_sent[tx.sha256] = time.time()
+                conn.send_message(msg_inv([CInv(1, tx.sha256)]))
+            else:
+                conn.send_message(msg_tx(tx))
+            sent += 1
+            if options.rate > 0:
+                delay = start + sent / options.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+    send_time = time.time() - start
+
+    # Wait for the mempool to hold everything (or stop growing for good).
+    accepted = 0
+    deadline = start + options.timeout
+    while time.time() < deadline:
+        accepted = rpc.getmempoolinfo()['size'] - baseline
+        if accepted >= total:
+            break
+        time.sleep(0.1)
+    accept_time = time.time() - start
+
+    # Then for the other nodes to have all of them.  Compare txids rather
+    # than mempool sizes, as those nodes may not have had the funding tx.
+    txids = set(tx.hash for chain in chains for tx in chain)
+    relayed = [0] * len(relay_rpcs)
+    relay_time = [None] * len(relay_rpcs)
+    while time.time() < deadline and None in relay_time:
+        for (i, relay_rpc) in enumerate(relay_rpcs):
+            if relay_time[i] is not None:
+                continue
+            # Cheap check first: a smaller mempool can't have them all
+            if relay_rpc.getmempoolinfo()['size'] >= total:
+                relayed[i] = len(txids.intersection(relay_rpc.getrawmempool()))
+                if relayed[i] >= total:
+                    relay_time[i] = time.time() - start
+        time.sleep(0.1)
+    for (i, relay_rpc) in enumerate(relay_rpcs):
+        if relay_time[i] is None:
+            relayed[i] = len(txids.intersection(relay_rpc.getrawmempool()))
+
+    # Flush outstanding rejects with a ping round trip on every connection.
+    for (conn, peer) in zip(connections, peers):
+        conn.send_message(msg_ping(1))
+    wait_until(lambda: all(p.last_pong == 1 for p in peers), 30)
+
+    with mininode_lock:
+        latency = [l for p in peers for l in p.getdata_latency]
+        rejects = defaultdict(int)
+        for p in peers:
+            for r in p.rejects:
+                rejects[(r.message, r.code, r.reason)] += 1
+        unrequested = sum(len(p.inv_sent) for p in peers)
+
+    print
+    print "sent:          %d txs in %.2fs (%.1f tx/s)" % (sent, send_time, sent / send_time)
+    print "accepted:      %d txs in %.2fs (%.1f tx/s)" % (accepted, accept_time, accepted / accept_time)
+    for (i, count) in enumerate(relayed):
+        if relay_time[i] is not None:
+            print "relayed:       %d txs to relay node %d in %.2fs (%.1f tx/s)" % \
+                (count, i, relay_time[i], count / relay_time[i])
+        else:
+            print "relayed:       %d txs to relay node %d before the timeout" % (count, i)
+    if options.mode == "inv":
+        print "inv->getdata:  p50 %.1fms  p90 %.1fms  p99 %.1fms  max %.1fms  (%d never requested)" % \
+            (percentile(latency, 50) * 1000, percentile(latency, 90) * 1000,
+             percentile(latency, 99) * 1000, percentile(latency, 100) * 1000, unrequested)
+    print "rejects:       %d" % sum(rejects.values())
+    for ((message, code, reason), count) in sorted(rejects.items()):
+        print "  %6d  %s 0x%02x %s" % (count, message, code, reason)
+
+    [ c.disconnect_node() for c in connections ]
+    relayed_all = None not in relay_time
+    sys.exit(0 if accepted >= total and relayed_all and not rejects else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@
 import sys; assert sys.version_info < (3,), ur"This script does not run under Python 3. Please use Python 2.7.x."
 
 from test_framework.mininode import NodeConn, NodeConnCB, NetworkThread, \
-    msg_filteradd, msg_filterclear, mininode_lock, SAPLING_PROTO_VERSION
+    msg_filteradd, msg_filterclear, SAPLING_PROTO_VERSION
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import initialize_chain_clean, start_nodes, \
     p2p_port, assert_equal
@@ -23,17 +23,6 @@ class TestNode(NodeConnCB):
     def add_connection(self, conn):
         self.connection = conn
 
-    # Spin until verack message is received from the node.
-    # We use this to signal that our test can begin. This
-    # is called from the testing thread, so it needs to acquire
-    # the global lock.
-    def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
-
     # Wrapper for the NodeConn's send_message function
     def send_message(self, message):
         self.connection.send_message(message)
@@ -68,8 +57,8 @@ class NodeBloomTest(BitcoinTestFramework):
         # Start up network handling in another thread
         NetworkThread().start()
 
-        nobf_node.wait_for_verack()
-        bf_node.wait_for_verack()
+        assert nobf_node.wait_for_verack(), "no verack from the node"
+        assert bf_node.wait_for_verack(), "no verack from the node"
 
         # Verify mininodes are connected to zcashd nodes
         peerinfo = self.nodes[0].getpeerinfo()
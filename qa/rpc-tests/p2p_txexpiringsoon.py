@@ -89,7 +89,7 @@ class TxExpiringSoonTest(BitcoinTestFramework):
 
         # Start up network handling in another thread
         NetworkThread().start()
-        testnode0.wait_for_verack()
+        assert testnode0.wait_for_verack(), "no verack from the node"
 
         # Verify mininodes are connected to zcashd nodes
         peerinfo = self.nodes[0].getpeerinfo()
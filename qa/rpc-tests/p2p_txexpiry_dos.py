@@ -35,7 +35,7 @@ class TxExpiryDoSTest(BitcoinTestFramework):
         # Start up network handling in another thread
         NetworkThread().start()
 
-        test_node.wait_for_verack()
+        assert test_node.wait_for_verack(), "no verack from the node"
 
         # Verify mininodes are connected to zcashd nodes
         peerinfo = self.nodes[0].getpeerinfo()
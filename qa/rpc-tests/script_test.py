@@ -147,7 +147,7 @@ class ScriptTest(ComparisonTestFramework):
 
     def run_test(self):
         # Set up the comparison tool TestManager
-        test = TestManager(self, self.options.tmpdir)
+        test = TestManager(self, self.options.tmpdir, self.options.pipeline_window)
         test.add_all_connections(self.nodes)
 
         # Load scripts
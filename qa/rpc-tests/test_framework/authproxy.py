@@ -5,12 +5,15 @@
   AuthServiceProxy has the following improvements over python-jsonrpc's
   ServiceProxy class:
 
-  - HTTP connections persist for the life of the AuthServiceProxy object
-    (if server supports HTTP/1.1)
+  - HTTP connections persist in a thread-safe pool shared by all proxies
+    for the same server (if server supports HTTP/1.1), so calls can be
+    issued concurrently from several threads
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
+  - batches calls with batch(), chunking large batches into several requests
   - sends Basic HTTP authentication headers
-  - parses all JSON numbers that look like floats as Decimal
+  - parses all JSON numbers that look like floats as Decimal, or as float
+    using orjson/ujson if available when created with decimal_floats=False
   - uses standard Python json lib
 
   Previous copyright, from python-jsonrpc/jsonrpc/proxy.py:
@@ -40,19 +43,43 @@ except ImportError:
     import httplib
 import base64
 import decimal
+import itertools
 import json
 import logging
+import socket
+import threading
+import time
 try:
     import urllib.parse as urlparse
 except ImportError:
     import urlparse
 
+# Optional fast JSON decoders. They return fractional numbers as float, so
+# they are only used by proxies created with decimal_floats=False.
+try:
+    import orjson
+    _fast_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _fast_loads = ujson.loads
+    except ImportError:
+        _fast_loads = None
+
 USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 600
 
+# Maximum number of calls sent in one HTTP request by RPCBatch
+BATCH_CHUNK_SIZE = 1000
+
 log = logging.getLogger("BitcoinRPC")
 
+# When set, called as call_observer(service_url, method, seconds,
+# request_bytes, response_bytes) after every completed request, e.g. by
+# the --profile-rpc option of BitcoinTestFramework.
+call_observer = None
+
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         Exception.__init__(self)
@@ -64,17 +91,97 @@ def EncodeDecimal(o):
         return round(o, 8)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+
+def decode_response(responsedata, decimal_floats=True):
+    """Parse a JSON-RPC response body (bytes).
+
+    With decimal_floats every fractional number is parsed exactly as a
+    Decimal. Without it numbers become floats, and orjson or ujson are used
+    when installed. Converting just the amount fields after a fast decode
+    would need a pass over the whole result in Python, which costs more than
+    the stdlib parse it replaces.
+    """
+    if decimal_floats:
+        return json.loads(responsedata.decode('utf8'), parse_float=decimal.Decimal)
+    if _fast_loads is not None:
+        return _fast_loads(responsedata)
+    return json.loads(responsedata.decode('utf8'))
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTP(S) connections to one server.
+
+    A connection is checked out for the duration of a single request, so any
+    number of threads can issue calls through proxies sharing the pool.
+    """
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self):
+        """Return (connection, reused)."""
+        with self.lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        port = 80 if self.url.port is None else self.url.port
+        if self.url.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+        return (conn, False)
+
+    def put(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(service_url, timeout=HTTP_TIMEOUT):
+    """Return the shared ConnectionPool for a service URL and timeout."""
+    url = urlparse.urlparse(service_url)
+    key = (url.scheme, url.hostname, url.port, timeout)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(url, timeout)
+        return _pools[key]
+
+
+def _is_disconnect(e):
+    # Python 2.7 error message was changed in https://github.com/python/cpython/pull/2825
+    # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset.
+    # ConnectionResetError happens on FreeBSD with Python 3.4.
+    # These classes don't exist in Python 2.x, so we can't refer to them directly.
+    return ((isinstance(e, httplib.BadStatusLine)
+                and e.line in ("''", "No status line received - the server has closed the connection"))
+            or e.__class__.__name__ in ('BrokenPipeError', 'ConnectionResetError'))
+
+
+def _is_stale(e):
+    # What a pooled keep-alive connection the server has since dropped
+    # (e.g. because the node was restarted) looks like.
+    return (isinstance(e, (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error))
+            and not isinstance(e, socket.timeout))
+
+
 class AuthServiceProxy(object):
-    __id_count = 0
+    _id_counter = itertools.count(1)
 
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None):
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, pool=None,
+                 decimal_floats=True):
         self.__service_url = service_url
+        self.__decimal_floats = decimal_floats
         self.__service_name = service_name
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -87,62 +194,71 @@ class AuthServiceProxy(object):
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
 
-        if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  None, None, False,
-                                                  timeout)
+        if pool is not None:
+            # Callables re-use the pool of the original proxy
+            self.__pool = pool
+        elif connection is not None:
+            # A caller-supplied connection gets a pool of its own
+            self.__pool = ConnectionPool(self.__url, timeout)
+            self.__pool.put(connection)
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 False, timeout)
+            self.__pool = get_pool(service_url, timeout)
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
             # Python internal stuff
             raise AttributeError
-        if self.__service_name is not None:
-            name = "%s.%s" % (self.__service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        proxy = AuthServiceProxy(self.__service_url, self._method_name(name), pool=self.__pool,
+                                 decimal_floats=self.__decimal_floats)
+        # Cache the callable so later lookups don't go through __getattr__
+        self.__dict__[name] = proxy
+        return proxy
 
-    def _request(self, method, path, postdata):
+    def _request(self, method, path, postdata, rpc_name=None):
         '''
-        Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
-        This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+        Do a HTTP request on a pooled connection, with retry if we get
+        disconnected (e.g. due to a timeout, or a server restart while the
+        connection sat idle in the pool).
+        This is also a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
         '''
         headers = {'Host': self.__url.hostname,
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
+        start = time.time()
+        (conn, reused) = self.__pool.get()
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except Exception as e:
-            # If connection was closed, try again.
-            # Python 2.7 error message was changed in https://github.com/python/cpython/pull/2825
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset.
-            # ConnectionResetError happens on FreeBSD with Python 3.4.
-            # These classes don't exist in Python 2.x, so we can't refer to them directly.
-            if ((isinstance(e, httplib.BadStatusLine)
-                    and e.line in ("''", "No status line received - the server has closed the connection"))
-                or e.__class__.__name__ in ('BrokenPipeError', 'ConnectionResetError')):
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
+            try:
+                conn.request(method, path, postdata, headers)
+                (response, size) = self._get_response(conn)
+            except Exception as e:
+                # If connection was closed, try again.
+                if _is_disconnect(e) or (reused and _is_stale(e)):
+                    conn.close()
+                    conn.request(method, path, postdata, headers)
+                    (response, size) = self._get_response(conn)
+                else:
+                    raise
+        except:
+            # Don't hand a connection in an unknown state to the next caller
+            conn.close()
+            raise
+        self.__pool.put(conn)
+        if call_observer is not None:
+            call_observer(self.__service_url, rpc_name, time.time() - start, len(postdata), size)
+        return response
 
     def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
+        request_id = next(AuthServiceProxy._id_counter)
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self.__service_name,
-                                 json.dumps(args, default=EncodeDecimal)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(request_id, self.__service_name,
+                                     json.dumps(args, default=EncodeDecimal)))
         postdata = json.dumps({'version': '1.1',
                                'method': self.__service_name,
                                'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal)
-        response = self._request('POST', self.__url.path, postdata)
+                               'id': request_id}, default=EncodeDecimal)
+        response = self._request('POST', self.__url.path, postdata, self.__service_name)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -151,21 +267,136 @@ class AuthServiceProxy(object):
         else:
             return response['result']
 
+    def batch(self, chunk_size=BATCH_CHUNK_SIZE):
+        """Return an RPCBatch queueing calls to be sent with this proxy."""
+        return RPCBatch(self, chunk_size)
+
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
-        log.debug("--> "+postdata)
-        return self._request('POST', self.__url.path, postdata)
+        log.debug("--> %s", postdata)
+        return self._request('POST', self.__url.path, postdata, "batch")
+
+    def _method_name(self, name):
+        if self.__service_name is not None:
+            return "%s.%s" % (self.__service_name, name)
+        return name
+
+    def _close(self):
+        """Close the idle connections in this proxy's pool."""
+        self.__pool.close()
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def _get_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
 
-        responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal)))
-        else:
-            log.debug("<-- "+responsedata)
-        return response
+        responsedata = http_response.read()
+        response = decode_response(responsedata, self.__decimal_floats)
+        # Log the body as received rather than re-serializing the result
+        log.debug("<-- %s", responsedata)
+        return (response, len(responsedata))
+
+
+class BatchResult(object):
+    """Result of one call queued on an RPCBatch, available once it has run."""
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def _set(self, response):
+        self._result = response.get('result')
+        self._error = response.get('error')
+        if self._error is None and 'result' not in response:
+            self._error = {'code': -343, 'message': 'missing JSON-RPC result'}
+        self._done = True
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the call's result, raising JSONRPCException if it failed."""
+        if not self._done:
+            raise RuntimeError("%s has not been executed yet" % self.method)
+        if self._error is not None:
+            raise JSONRPCException(self._error)
+        return self._result
+
+    def __repr__(self):
+        return "BatchResult(%s%r)" % (self.method, tuple(self.params))
+
+
+class RPCBatch(object):
+    """Queue of JSON-RPC calls sent as batch requests.
+
+    Calls are queued by calling methods on the batch, and each returns a
+    BatchResult. The queue is sent when the with-block exits (or on
+    execute()), at most chunk_size calls per HTTP request:
+
+        with node.batch() as b:
+            hashes = [b.getblockhash(h) for h in range(count)]
+        hashes = [r.result() for r in hashes]
+    """
+
+    def __init__(self, proxy, chunk_size=BATCH_CHUNK_SIZE):
+        self._proxy = proxy
+        self._chunk_size = chunk_size
+        self._queue = []
+        self._executed = []
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        method = self._proxy._method_name(name)
+        queue_call = lambda *args: self._queue_call(method, args)
+        self.__dict__[name] = queue_call
+        return queue_call
+
+    def _queue_call(self, method, params):
+        result = BatchResult(method, params)
+        self._queue.append((next(AuthServiceProxy._id_counter), result))
+        return result
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self):
+        """Send the queued calls and return their BatchResults in call order."""
+        queue, self._queue = self._queue, []
+        for i in range(0, len(queue), self._chunk_size):
+            chunk = queue[i:i+self._chunk_size]
+            responses = self._proxy._batch(
+                {'version': '1.1', 'method': r.method, 'params': r.params, 'id': request_id}
+                for (request_id, r) in chunk)
+            if not isinstance(responses, list):
+                # The whole request was rejected
+                raise JSONRPCException(responses.get('error') or {
+                    'code': -342, 'message': 'unexpected batch response from server'})
+            # Responses may come back in any order
+            by_id = dict((response.get('id'), response) for response in responses)
+            for (request_id, r) in chunk:
+                r._set(by_id.get(request_id, {'result': None, 'error': {
+                    'code': -343, 'message': 'missing JSON-RPC response in batch'}}))
+        executed = [r for (_, r) in queue]
+        self._executed.extend(executed)
+        return executed
+
+    def results(self):
+        """Return the results of all calls in order, executing any still queued.
+
+        Raises JSONRPCException for the first call that failed.
+        """
+        self.execute()
+        return [r.result() for r in self._executed]
@@ -3,52 +3,108 @@
 #             and for constructing a getheaders message
 #
 
-from mininode import CBlock, CBlockHeader, CBlockLocator, CTransaction, msg_block, msg_headers, msg_tx
+from mininode import CBlock, CBlockHeader, CBlockLocator, CTransaction, \
+    msg_block, msg_headers, msg_tx, deser_from_buffer
 
 import sys
+import copy
 import cStringIO
 import dbm
+from collections import OrderedDict
+
+# Number of deserialized blocks kept by BlockStore.get()
+BLOCK_CACHE_SIZE = 128
 
 class BlockStore(object):
-    def __init__(self, datadir):
+    def __init__(self, datadir, cache_size=BLOCK_CACHE_SIZE):
         self.blockDB = dbm.open(datadir + "/blocks", 'c')
         self.currentBlock = 0L
+        # Header index, block hash -> (CBlockHeader, height), so that
+        # walking the chain for getheaders or a locator never has to read
+        # and deserialize whole blocks from the database. The height of a
+        # block is None unless its parent is indexed with a known height.
+        self.headers = {}
+        # Most recently used deserialized blocks, oldest first
+        self.blockCache = OrderedDict()
+        self.cacheSize = cache_size
+        # Rebuild the index of a reopened database, parents first
+        stored = {}
+        for key in self.blockDB.keys():
+            header = deser_from_buffer(CBlockHeader, self.blockDB[key])
+            header.calc_sha256()
+            stored[header.sha256] = header
+        for header in stored.values():
+            missing = []
+            while header is not None and header.sha256 not in self.headers:
+                missing.append(header)
+                header = stored.get(header.hashPrevBlock)
+            for header in reversed(missing):
+                self._index(header)
 
     def close(self):
         self.blockDB.close()
 
+    def _index(self, header):
+        header.calc_sha256()
+        parent = self.headers.get(header.hashPrevBlock)
+        height = None
+        if parent is not None and parent[1] is not None:
+            height = parent[1] + 1
+        self.headers[header.sha256] = (header, height)
+
+    # Returns the cached instance, which must not be modified
+    def _get_cached(self, blockhash):
+        ret = self.blockCache.pop(blockhash, None)
+        if ret is None:
+            serialized_block = None
+            try:
+                serialized_block = self.blockDB[repr(blockhash)]
+            except KeyError:
+                return None
+            ret = deser_from_buffer(CBlock, serialized_block)
+            ret.calc_sha256()
+            if len(self.blockCache) >= self.cacheSize:
+                self.blockCache.popitem(last=False)
+        self.blockCache[blockhash] = ret
+        return ret
+
     def get(self, blockhash):
-        serialized_block = None
-        try:
-            serialized_block = self.blockDB[repr(blockhash)]
-        except KeyError:
+        ret = self._get_cached(blockhash)
+        if ret is None:
             return None
-        f = cStringIO.StringIO(serialized_block)
-        ret = CBlock()
-        ret.deserialize(f)
-        ret.calc_sha256()
-        return ret
+        # The caller may modify the block, so don't hand out the cached one
+        return copy.deepcopy(ret)
+
+    def get_header(self, blockhash):
+        entry = self.headers.get(blockhash)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def get_height(self, blockhash):
+        entry = self.headers.get(blockhash)
+        if entry is None:
+            return None
+        return entry[1]
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block = self.get(current_tip)
-        if current_block is None:
+        header = self.get_header(current_tip)
+        if header is None:
             return None
 
         response = msg_headers()
-        headersList = [ CBlockHeader(current_block) ]
+        have = set(locator.vHave)
+        headersList = [ header ]
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlock = self.get(prevBlockHash)
-            if prevBlock is not None:
-                headersList.insert(0, CBlockHeader(prevBlock))
+        while headersList[-1].sha256 not in have:
+            header = self.get_header(headersList[-1].hashPrevBlock)
+            if header is not None:
+                headersList.append(header)
             else:
                 break
+        headersList.reverse()
         headersList = headersList[:maxheaders] # truncate if we have too many
         hashList = [x.sha256 for x in headersList]
         index = len(headersList)
@@ -63,13 +119,16 @@ class BlockStore(object):
             self.blockDB[repr(block.sha256)] = bytes(block.serialize())
         except TypeError as e:
             print "Unexpected error: ", sys.exc_info()[0], e.args
+        self._index(CBlockHeader(block))
+        # The block may have been changed and re-added under the same hash
+        self.blockCache.pop(block.sha256, None)
         self.currentBlock = block.sha256
 
     def get_blocks(self, inv):
         responses = []
         for i in inv:
             if (i.type == 2): # MSG_BLOCK
-                block = self.get(i.hash)
+                block = self._get_cached(i.hash)
                 if block is not None:
                     responses.append(msg_block(block))
         return responses
@@ -80,11 +139,11 @@ class BlockStore(object):
         r = []
         counter = 0
         step = 1
-        lastBlock = self.get(current_tip)
+        lastBlock = self.get_header(current_tip)
         while lastBlock is not None:
             r.append(lastBlock.hashPrevBlock)
             for i in range(step):
-                lastBlock = self.get(lastBlock.hashPrevBlock)
+                lastBlock = self.get_header(lastBlock.hashPrevBlock)
                 if lastBlock is None:
                     break
             counter += 1
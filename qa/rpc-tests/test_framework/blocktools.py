@@ -4,8 +4,13 @@
 # file COPYING or https://www.opensource.org/licenses/mit-license.php .
 #
 
-from mininode import CBlock, CTransaction, CTxIn, CTxOut, COutPoint
+from mininode import CBlock, CTransaction, CTxIn, CTxOut, COutPoint, \
+    hash256, ser_char_vector, ser_uint256, uint256_from_compact, uint256_from_str
 from script import CScript, OP_0, OP_EQUAL, OP_HASH160
+from equihash import gbp_solve, gbp_validate_batch, hash_nonce, zcash_person
+
+import multiprocessing
+from pyblake2 import blake2b
 
 # Create a block (with regtest difficulty)
 def create_block(hashprev, coinbase, nTime=None, nBits=None, hashFinalSaplingRoot=None):
@@ -69,6 +74,152 @@ def create_coinbase(heightAdjust = 0):
     coinbase.calc_sha256()
     return coinbase
 
+# Builds a chain of solved blocks client-side, on top of a given tip.
+# Blocks are solved with miner (a BlockMiner) if given, else CBlock.solve.
+class BlockFactory(object):
+    def __init__(self, tip, height, block_time, nBits=None, miner=None):
+        self.tip = tip
+        self.height = height
+        self.block_time = block_time
+        self.nBits = nBits
+        self.miner = miner
+
+    @classmethod
+    def from_node(cls, node, miner=None):
+        besthash = node.getbestblockhash()
+        best = node.getblock(besthash)
+        return cls(int(besthash, 16), best['height'], best['time'], miner=miner)
+
+    # Return the next block, with an anyone-can-spend coinbase and txs
+    def next_block(self, txs=None):
+        self.height += 1
+        self.block_time += 1
+        coinbase = create_coinbase(self.height - counter)
+        block = create_block(self.tip, coinbase, self.block_time, self.nBits)
+        if txs:
+            block.vtx.extend(txs)
+            block.hashMerkleRoot = block.calc_merkle_root()
+        if self.miner is not None:
+            self.miner.solve(block)
+        else:
+            block.solve()
+        self.tip = block.sha256
+        return block
+
+    def blocks(self, count):
+        return [ self.next_block() for i in range(count) ]
+
+# BlockMiner: solves blocks with a pool of worker processes.
+#
+# solve() splits the nonce space of one block across the workers (worker i
+# tries nonces i, i+processes, ...) and takes the first solution found, so
+# the nonce may differ from the one CBlock.solve would find. The other
+# workers are cancelled by bumping a shared generation counter, which they
+# check between nonces. solve_chain() mines a list of blocks that build on
+# each other, relinking each one to the solved block before it, and
+# solve_all() mines independent blocks (e.g. the tips of competing forks),
+# one per worker. The pool is started once and reused until close().
+
+# Shared generation counter, set in the worker processes by _init_miner.
+# Only the parent process writes it, so it has no lock and the workers can
+# read it after every nonce without contending for one.
+_miner_generation = None
+
+def _init_miner(generation):
+    global _miner_generation
+    _miner_generation = generation
+
+def _search_nonces(args):
+    (generation, prefix, target, first, step, n, k) = args
+    digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
+    digest.update(prefix)
+    nonce = first
+    while generation is None or _miner_generation.value == generation:
+        curr_digest = digest.copy()
+        hash_nonce(curr_digest, nonce)
+        for soln in gbp_solve(curr_digest, n, k):
+            header = prefix + ser_uint256(nonce) + ser_char_vector(soln)
+            if uint256_from_str(hash256(header)) <= target:
+                return (nonce, soln)
+        nonce += step
+    return None
+
+class BlockMiner(object):
+    def __init__(self, processes=None, n=48, k=5):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.n = n
+        self.k = k
+        self.generation = multiprocessing.Value('L', 0, lock=False)
+        self.pool = multiprocessing.Pool(processes, _init_miner, (self.generation,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.next_generation()
+        self.pool.close()
+        self.pool.join()
+
+    def next_generation(self):
+        self.generation.value += 1
+        return self.generation.value
+
+    def search_args(self, block, generation, first, step):
+        return (generation, block.serialize_prefix(), uint256_from_compact(block.nBits),
+                first, step, self.n, self.k)
+
+    def solve(self, block):
+        generation = self.next_generation()
+        tasks = [ self.search_args(block, generation, i, self.processes)
+                  for i in range(self.processes) ]
+        result = None
+        for result in self.pool.imap_unordered(_search_nonces, tasks):
+            if result is not None:
+                break
+        # Stop the other workers; their results are dropped
+        self.next_generation()
+        if result is None:
+            raise RuntimeError("nonce search was cancelled")
+        (block.nNonce, block.nSolution) = result
+        block.rehash()
+        return block
+
+    def solve_chain(self, blocks):
+        for (prev, block) in zip([ None ] + blocks[:-1], blocks):
+            if prev is not None:
+                block.hashPrevBlock = prev.sha256
+            self.solve(block)
+        return blocks
+
+    def solve_all(self, blocks):
+        tasks = [ self.search_args(block, None, 0, 1) for block in blocks ]
+        for (block, (nonce, soln)) in zip(blocks, self.pool.map(_search_nonces, tasks, chunksize=1)):
+            block.nNonce = nonce
+            block.nSolution = soln
+            block.rehash()
+        return blocks
+
+# Submit blocks to node in one JSON-RPC batch request, raising if any of
+# them is rejected
+def submit_blocks(node, blocks):
+    b = node.batch()
+    for block in blocks:
+        b.submitblock(block.serialize().encode('hex'))
+    for (block, result) in zip(blocks, b.results()):
+        if result is not None:
+            raise AssertionError("block %064x rejected: %s" % (block.sha256, result))
+
+# Check the Equihash solutions of many headers (or blocks) at once, see
+# equihash.gbp_validate_batch. Returns a list of booleans.
+def check_solutions(headers, n=48, k=5, processes=1):
+    return gbp_validate_batch([ (h.equihash_input(), h.nSolution) for h in headers ],
+                              n, k, processes)
+
 # Create a transaction with an anyone-can-spend output, that spends the
 # nth output of prevtx.
 def create_transaction(prevtx, n, sig, value):
@@ -6,11 +6,10 @@
 
 from mininode import CBlock, CTransaction, CInv, NodeConn, NodeConnCB, \
     msg_inv, msg_getheaders, msg_ping, msg_mempool, mininode_lock, MAX_INV_SZ
+import mininode
 from blockstore import BlockStore, TxStore
 from util import p2p_port
 
-import time
-
 '''
 This is a tool for comparing two or more bitcoinds to each other
 using a script provided.
@@ -28,19 +27,11 @@ generator that returns TestInstance objects.  See below for definition.
 # on_getheaders: provide headers via BlockStore
 # on_getdata: provide blocks via BlockStore
 
+# Wait until predicate() holds, re-evaluating it whenever a P2P message has
+# been delivered. attempts is kept from when this polled every 50ms: it
+# limits the wait to attempts*50ms.
 def wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
-
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
-            if predicate():
-                return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
-
-    return False
+    return mininode.wait_until(predicate, min(timeout, attempts * 0.05))
 
 class TestNode(NodeConnCB):
 
@@ -53,6 +44,8 @@ class TestNode(NodeConnCB):
         self.block_request_map = {}
         self.tx_store = tx_store
         self.tx_request_map = {}
+        # Blocks inv'ed to the node that it hasn't asked for yet
+        self.unrequested = set()
 
         # When the pingmap is non-empty we're waiting for 
         # a response
@@ -86,6 +79,7 @@ class TestNode(NodeConnCB):
                 self.tx_request_map[i.hash] = True
             elif i.type == 2:
                 self.block_request_map[i.hash] = True
+                self.unrequested.discard(i.hash)
 
     def on_inv(self, conn, message):
         self.lastInv = [x.hash for x in message.inv]
@@ -98,6 +92,9 @@ class TestNode(NodeConnCB):
 
     def send_inv(self, obj):
         mtype = 2 if isinstance(obj, CBlock) else 1
+        if mtype == 2:
+            with mininode_lock:
+                self.unrequested.add(obj.sha256)
         self.conn.send_message(msg_inv([CInv(mtype, obj.sha256)]))
 
     def send_getheaders(self):
@@ -146,15 +143,30 @@ class TestInstance(object):
         self.sync_every_block = sync_every_block
         self.sync_every_tx = sync_every_tx
 
+# TestManager:
+#
+# pipeline_window: if non-zero, blocks of sync_every_block instances are
+#    streamed instead of synced one at a time: invs are sent as long as no
+#    connection has pipeline_window blocks it hasn't requested yet, and the
+#    getheaders/ping barrier is only run for blocks whose outcome can't be
+#    inferred from the next one.  An accepted block followed by an accepted
+#    child is implied by the child becoming the tip, so runs of good blocks
+#    are checked once at their end; rejected blocks, blocks with a None
+#    outcome and the last block of an instance are always checked.
+
+# Seconds each block may take to be requested before a sync fails
+BLOCK_REQUEST_TIMEOUT = 1
+
 class TestManager(object):
 
-    def __init__(self, testgen, datadir):
+    def __init__(self, testgen, datadir, pipeline_window=0):
         self.test_generator = testgen
         self.connections    = []
         self.test_nodes     = []
         self.block_store    = BlockStore(datadir)
         self.tx_store       = TxStore(datadir)
         self.ping_counter   = 1
+        self.pipeline_window = pipeline_window
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -205,6 +217,42 @@ class TestManager(object):
         self.wait_for_pings(self.ping_counter)
         self.ping_counter += 1
 
+    # Pipelined sync_blocks: the node requests blocks in the order they were
+    # inv'ed, so once blockhash is requested all blocks before it are too.
+    def barrier_blocks(self, blockhash):
+        def blocks_requested():
+            return all(node.block_request_map.get(blockhash) for node in self.test_nodes)
+
+        timeout = BLOCK_REQUEST_TIMEOUT * (self.pipeline_window + 1)
+        if not wait_until(blocks_requested, timeout=timeout):
+            raise AssertionError("Not all nodes requested block")
+
+        [ c.cb.send_getheaders() for c in self.connections ]
+        [ c.cb.send_ping(self.ping_counter) for c in self.connections ]
+        self.wait_for_pings(self.ping_counter)
+        self.ping_counter += 1
+
+    # Send the inv for block once every connection has room for it in the
+    # pipeline window.
+    def stream_block(self, block):
+        def window_open():
+            return all(len(node.unrequested) < self.pipeline_window for node in self.test_nodes)
+
+        timeout = BLOCK_REQUEST_TIMEOUT * self.pipeline_window
+        if not wait_until(window_open, timeout=timeout):
+            raise AssertionError("Not all nodes requested block")
+        [ c.cb.send_inv(block) for c in self.connections ]
+
+    # Whether the outcome of the block at index i of objects has to be
+    # checked, or is implied by that of the next one.
+    def must_check(self, objects, i):
+        block, outcome = objects[i]
+        if outcome is not True or i + 1 == len(objects):
+            return True
+        child, child_outcome = objects[i + 1]
+        return not (isinstance(child, CBlock) and child_outcome is True and
+                    child.hashPrevBlock == block.sha256)
+
     # Analogous to sync_block (see above)
     def sync_transaction(self, txhash, num_events):
         # Wait for nodes to request transaction (50ms sleep * 20 tries * num_events)
@@ -277,7 +325,8 @@ class TestManager(object):
             [ tx, tx_outcome ] = [ None, None ]
             invqueue = []
 
-            for b_or_t, outcome in test_instance.blocks_and_transactions:
+            objects = test_instance.blocks_and_transactions
+            for i, (b_or_t, outcome) in enumerate(objects):
                 # Determine if we're dealing with a block or tx
                 if isinstance(b_or_t, CBlock):  # Block test runner
                     block = b_or_t
@@ -289,7 +338,13 @@ class TestManager(object):
                             c.cb.block_request_map[block.sha256] = False
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
-                    if (test_instance.sync_every_block):
+                    if (test_instance.sync_every_block and self.pipeline_window):
+                        self.stream_block(block)
+                        if self.must_check(objects, i):
+                            self.barrier_blocks(block.sha256)
+                            if (not self.check_results(block.sha256, outcome)):
+                                raise AssertionError("Test failed at test %d" % test_number)
+                    elif (test_instance.sync_every_block):
                         [ c.cb.send_inv(block) for c in self.connections ]
                         self.sync_blocks(block.sha256, 1)
                         if (not self.check_results(block.sha256, outcome)):
@@ -1,6 +1,14 @@
 from operator import itemgetter
+import multiprocessing
 import struct
 
+from pyblake2 import blake2b
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEBUG = False
 VERBOSE = False
 
@@ -227,6 +235,100 @@ def gbp_basic(digest, n, k):
             j -= 1
     return [get_minimal_from_indices(soln, collision_length+1) for soln in solns]
 
+def _np_expand_hashes(hashes, n, k):
+    '''Vectorized expand_array over the rows of hashes (n/8 bytes each).'''
+    collision_length = n/(k+1)
+    width = (collision_length+7)//8
+    bits = numpy.unpackbits(hashes, axis=1).reshape(len(hashes), k+1, collision_length)
+    padded = numpy.zeros((len(hashes), k+1, 8*width), dtype=numpy.uint8)
+    padded[:, :, 8*width-collision_length:] = bits
+    return numpy.packbits(padded.reshape(len(hashes), -1), axis=1)
+
+def _np_collisions(X, cols):
+    '''
+    Sort the rows of X (stably, like list.sort) and return (order, hi, lo):
+    the sort order, and the sorted positions of every pair of rows that
+    agree on the columns cols, in the order gbp_basic visits them (from the
+    end of the sorted list, each group's pairs (-1-l, -1-m) with l < m).
+    '''
+    order = numpy.lexsort(X.T[::-1])
+    keys = X[order][:, cols]
+    # Group id of every sorted row: rows equal on cols are adjacent
+    starts = numpy.ones(len(keys), dtype=bool)
+    starts[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+    group = numpy.cumsum(starts)
+    his = []
+    los = []
+    d = 1
+    while d < len(keys):
+        same = numpy.nonzero(group[d:] == group[:-d])[0]
+        if len(same) == 0:
+            break
+        his.append(same + d)
+        los.append(same)
+        d += 1
+    if not his:
+        empty = numpy.zeros(0, dtype=numpy.intp)
+        return order, empty, empty
+    hi = numpy.concatenate(his)
+    lo = numpy.concatenate(los)
+    visit = numpy.lexsort((-lo, -hi))
+    return order, hi[visit], lo[visit]
+
+def _np_combine(X, I, order, hi, lo):
+    '''XOR the pairs of rows, dropping those sharing an index, and join
+    their index lists with the smaller first index first.'''
+    a = order[hi]
+    b = order[lo]
+    distinct = ~(I[a][:, :, None] == I[b][:, None, :]).any(axis=(1, 2))
+    a = a[distinct]
+    b = b[distinct]
+    swap = I[a, 0] > I[b, 0]
+    first = numpy.where(swap, b, a)
+    second = numpy.where(swap, a, b)
+    return X[a] ^ X[b], numpy.concatenate((I[first], I[second]), axis=1)
+
+def gbp_vectorized(digest, n, k):
+    '''
+    gbp_basic with the list kept as NumPy arrays (one row of expanded hash
+    bytes and one row of indices per entry) and every round done with
+    array operations. Finds the same solutions, in the same order.
+    '''
+    validate_params(n, k)
+    collision_length = n/(k+1)
+    indices_per_hash_output = 512/n
+    rows = 2**(collision_length+1)
+
+    # 1) Generate first list
+    outputs = []
+    for xi in range((rows + indices_per_hash_output - 1)/indices_per_hash_output):
+        curr_digest = digest.copy()
+        hash_xi(curr_digest, xi)
+        outputs.append(curr_digest.digest())
+    hashes = numpy.frombuffer(b''.join(outputs), dtype=numpy.uint8)
+    hashes = hashes.reshape(-1, n/8)[:rows]
+    X = _np_expand_hashes(hashes, n, k)
+    I = numpy.arange(rows, dtype=numpy.uint32).reshape(rows, 1)
+
+    # Bytes compared by has_collision(.., i, collision_length)
+    def collision_cols(i):
+        return numpy.arange((i-1)*collision_length/8, i*collision_length/8)
+
+    # 2) Collide on the next n/(k+1) bits, k-1 times
+    for i in range(1, k):
+        order, hi, lo = _np_collisions(X, collision_cols(i))
+        X, I = _np_combine(X, I, order, hi, lo)
+
+    # k+1) Find a collision on the last 2n/(k+1) bits
+    cols = numpy.concatenate((collision_cols(k), collision_cols(k+1)))
+    order, hi, lo = _np_collisions(X, cols)
+    X, I = _np_combine(X, I, order, hi, lo)
+    solns = I[~X.any(axis=1)]
+    return [get_minimal_from_indices(list(soln), collision_length+1) for soln in solns]
+
+# The solver CBlock.solve uses
+gbp_solve = gbp_basic if numpy is None else gbp_vectorized
+
 def gbp_validate(digest, minimal, n, k):
     validate_params(n, k)
     collision_length = n/(k+1)
@@ -251,32 +353,143 @@ def gbp_validate(digest, minimal, n, k):
                          hash_length, collision_length),
             (i,)
         ))
+    return validate_tree(X, n, k)
+
+def validate_tree(X, n, k, verbose=True):
+    '''Check the collisions, ordering and final zeroes of the tree over the
+    expanded hashes X, given as (hash, (index,)) pairs in solution order.'''
+    collision_length = n/(k+1)
+    hash_length = (k+1)*((collision_length+7)//8)
+
+    def invalid(message):
+        if verbose:
+            print message
+        return False
 
     for r in range(1, k+1):
         Xc = []
         for i in range(0, len(X), 2):
             if not has_collision(X[i][0], X[i+1][0], r, collision_length):
-                print 'Invalid solution: invalid collision length between StepRows'
-                return False
+                return invalid('Invalid solution: invalid collision length between StepRows')
             if X[i+1][1][0] < X[i][1][0]:
-                print 'Invalid solution: Index tree incorrectly ordered'
-                return False
+                return invalid('Invalid solution: Index tree incorrectly ordered')
             if not distinct_indices(X[i][1], X[i+1][1]):
-                print 'Invalid solution: duplicate indices'
-                return False
+                return invalid('Invalid solution: duplicate indices')
             Xc.append((xor(X[i][0], X[i+1][0]), X[i][1] + X[i+1][1]))
         X = Xc
 
     if len(X) != 1:
-        print 'Invalid solution: incorrect length after end of rounds: %d' % len(X)
-        return False
+        return invalid('Invalid solution: incorrect length after end of rounds: %d' % len(X))
 
     if count_zeroes(X[0][0]) != 8*hash_length:
-        print 'Invalid solution: incorrect number of zeroes: %d' % count_zeroes(X[0][0])
-        return False
+        return invalid('Invalid solution: incorrect number of zeroes: %d' % count_zeroes(X[0][0]))
 
     return True
 
+# gbp_validate_batch: validate many Equihash solutions at once.
+#
+# Items are (header, minimal) pairs, header being the Equihash input I||V
+# (the serialized block header up to and including nNonce). The
+# personalised BLAKE2b state is created once, and the state after the
+# header up to the nonce is shared by the items that have it in common.
+# Hash outputs are computed once per x_i even when several indices of a
+# solution fall in the same 512-bit output. With NumPy the trees of the
+# whole batch are checked with array operations, and with processes > 1
+# the items are split across a multiprocessing pool.
+
+def _solution_hashes(state, minimal, n, k):
+    '''Return (indices, hash slices) of a solution, or None if its length is wrong.'''
+    collision_length = n/(k+1)
+    indices_per_hash_output = 512/n
+    if len(minimal) != (1 << k)*(collision_length+1)//8:
+        return None
+    outputs = {}
+    indices = get_indices_from_minimal(minimal, collision_length+1)
+    hashes = []
+    for i in indices:
+        xi, r = divmod(i, indices_per_hash_output)
+        output = outputs.get(xi)
+        if output is None:
+            output = outputs[xi] = hash_xi(state.copy(), xi).digest()
+        hashes.append(output[r*n/8:(r+1)*n/8])
+    return indices, hashes
+
+def _np_validate_trees(X, I, n, k):
+    '''validate_tree for a batch: X is (batch, 2^k, hash_length) expanded
+    hashes, I the (batch, 2^k) indices. Returns a boolean array.'''
+    collision_length = n/(k+1)
+    valid = numpy.ones(len(X), dtype=bool)
+    # Distinct within every subtree pair comes down to all distinct
+    ordered = numpy.sort(I, axis=1)
+    valid &= (ordered[:, 1:] != ordered[:, :-1]).all(axis=1)
+    for r in range(1, k+1):
+        left = X[:, 0::2]
+        right = X[:, 1::2]
+        cols = slice((r-1)*collision_length/8, r*collision_length/8)
+        valid &= (left[:, :, cols] == right[:, :, cols]).all(axis=(1, 2))
+        # First index of every right subtree not below its left sibling's
+        subtrees = I.reshape(len(I), -1, 2**r)
+        valid &= (subtrees[:, :, 2**(r-1)] >= subtrees[:, :, 0]).all(axis=1)
+        X = left ^ right
+    valid &= ~X.reshape(len(X), -1).any(axis=1)
+    return valid
+
+def _validate_chunk(args):
+    (items, n, k) = args
+    collision_length = n/(k+1)
+    hash_length = (k+1)*((collision_length+7)//8)
+    base = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
+    states = {}
+    results = [False] * len(items)
+    rows = []
+    for (j, (header, minimal)) in enumerate(items):
+        # Reuse the state after everything but the nonce
+        prefix = header[:-32]
+        state = states.get(prefix)
+        if state is None:
+            state = states[prefix] = base.copy()
+            state.update(prefix)
+        state = state.copy()
+        state.update(header[-32:])
+        solution = _solution_hashes(state, minimal, n, k)
+        if solution is None:
+            continue
+        (indices, hashes) = solution
+        if numpy is None:
+            X = [ (expand_array(bytearray(h), hash_length, collision_length), (i,))
+                  for (i, h) in zip(indices, hashes) ]
+            results[j] = validate_tree(X, n, k, verbose=False)
+        else:
+            rows.append((j, indices, b''.join(hashes)))
+    if rows:
+        hashes = numpy.frombuffer(b''.join(h for (_, _, h) in rows), dtype=numpy.uint8)
+        X = _np_expand_hashes(hashes.reshape(-1, n/8), n, k).reshape(len(rows), 1 << k, -1)
+        I = numpy.array([ indices for (_, indices, _) in rows ], dtype=numpy.uint32)
+        for ((j, _, _), valid) in zip(rows, _np_validate_trees(X, I, n, k)):
+            results[j] = bool(valid)
+    return results
+
+def gbp_validate_batch(items, n, k, processes=1):
+    '''
+    Validate (header, minimal) pairs, header being the Equihash input I||V.
+    Returns a list of booleans. processes > 1 spreads the items over that
+    many worker processes; None uses one per CPU.
+    '''
+    validate_params(n, k)
+    items = [ (bytes(header), minimal) for (header, minimal) in items ]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(items) < 2:
+        return _validate_chunk((items, n, k))
+    size = (len(items) + processes - 1) // processes
+    chunks = [ (items[i:i+size], n, k) for i in range(0, len(items), size) ]
+    pool = multiprocessing.Pool(min(processes, len(chunks)))
+    try:
+        return sum(pool.map(_validate_chunk, chunks), [])
+    finally:
+        pool.close()
+        pool.join()
+
 def zcash_person(n, k):
     return b'ZcashPoW' + struct.pack('<II', n, k)
 
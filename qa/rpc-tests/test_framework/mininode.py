@@ -26,14 +26,19 @@ import sys
 import random
 import cStringIO
 import hashlib
-from threading import RLock
+import errno
+import fcntl
+import os
+from collections import deque
+from threading import Lock, RLock
 from threading import Thread
+from threading import Condition, Timer
 import logging
 import copy
 from pyblake2 import blake2b
 
 from .equihash import (
-    gbp_basic,
+    gbp_solve,
     gbp_validate,
     hash_nonce,
     zcash_person,
@@ -69,12 +74,50 @@ mininode_socket_map = dict()
 
 # One lock for synchronizing all data access between the networking thread (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
+# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB.
+# This lock should be acquired in the thread running the test logic to
+# synchronize access to any data shared with the NodeConnCB or NodeConn.
+# Outgoing messages do not need it: each NodeConn has its own send queue.
 mininode_lock = RLock()
 
+# Notified, with mininode_lock held, whenever a message has been delivered
+# to a NodeConnCB or a connection has closed.
+mininode_cv = Condition(mininode_lock)
+
+def wait_on(cv, predicate, timeout):
+    """
+    Wait until predicate() holds, re-evaluating it (under the condition's
+    lock) every time cv is notified. Returns False after timeout seconds.
+
+    Python 2's Condition.wait(timeout) polls in sleeps of up to 50ms, while
+    a wait without timeout wakes as soon as it is notified, so the timeout
+    is implemented by a timer that notifies cv instead.
+    """
+    deadline = time.time() + timeout
+    timer = None
+    with cv:
+        try:
+            while not predicate():
+                if time.time() >= deadline:
+                    return False
+                if timer is None and timeout != float('inf'):
+                    timer = Timer(timeout, _notify_all, (cv,))
+                    timer.daemon = True
+                    timer.start()
+                cv.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+    return True
+
+def _notify_all(cv):
+    with cv:
+        cv.notify_all()
+
+def wait_until(predicate, timeout=60):
+    """Wait until predicate() holds after delivery of P2P messages, at most timeout seconds."""
+    return wait_on(mininode_cv, predicate, timeout)
+
 # Serialization/deserialization tools
 def sha256(s):
     return hashlib.new('sha256', s).digest()
@@ -286,6 +329,88 @@ def ser_char_vector(l):
     return r
 
 
+# Buffer deserialization tools
+#
+# The deser_*_from functions walk a str (or any object supporting the buffer
+# protocol, e.g. a memoryview) with an explicit offset cursor instead of
+# reading through a file-like object.  Each one takes (buf, pos) and returns
+# (value, new_pos), so a whole message is parsed without copying anything
+# other than the fields that end up stored on the resulting objects.
+_struct_B = struct.Struct("<B")
+_struct_H = struct.Struct("<H")
+_struct_I = struct.Struct("<I")
+_struct_i = struct.Struct("<i")
+_struct_Q = struct.Struct("<Q")
+_struct_q = struct.Struct("<q")
+_struct_uint256 = struct.Struct("<QQQQ")
+
+
+def buffer_from(b):
+    # Field slices of a str are str, which is what the objects below store.
+    # Anything else (memoryview, bytearray, buffer) is flattened exactly once.
+    if isinstance(b, str):
+        return b
+    if isinstance(b, memoryview):
+        return b.tobytes()
+    return str(b)
+
+
+def deser_from_buffer(c, b, pos=0):
+    """Deserialize an instance of class c from b, starting at offset pos."""
+    t = c()
+    t.deserialize_from(buffer_from(b), pos)
+    return t
+
+
+def deser_compact_size_from(buf, pos):
+    nit = _struct_B.unpack_from(buf, pos)[0]
+    pos += 1
+    if nit == 253:
+        nit = _struct_H.unpack_from(buf, pos)[0]
+        pos += 2
+    elif nit == 254:
+        nit = _struct_I.unpack_from(buf, pos)[0]
+        pos += 4
+    elif nit == 255:
+        nit = _struct_Q.unpack_from(buf, pos)[0]
+        pos += 8
+    return nit, pos
+
+
+def deser_string_from(buf, pos):
+    nit, pos = deser_compact_size_from(buf, pos)
+    if pos + nit > len(buf):
+        raise ValueError("truncated string at offset %d" % pos)
+    return buf[pos:pos+nit], pos + nit
+
+
+def deser_bytes_from(buf, pos, n):
+    if pos + n > len(buf):
+        raise ValueError("truncated data at offset %d" % pos)
+    return buf[pos:pos+n], pos + n
+
+
+def deser_uint256_from(buf, pos):
+    a, b, c, d = _struct_uint256.unpack_from(buf, pos)
+    return a | (b << 64) | (c << 128) | (d << 192), pos + 32
+
+
+def deser_vector_from(buf, pos, c):
+    nit, pos = deser_compact_size_from(buf, pos)
+    r = []
+    for i in xrange(nit):
+        t = c()
+        pos = t.deserialize_from(buf, pos)
+        r.append(t)
+    return r, pos
+
+
+def deser_char_vector_from(buf, pos):
+    nit, pos = deser_compact_size_from(buf, pos)
+    data, pos = deser_bytes_from(buf, pos, nit)
+    return list(bytearray(data)), pos
+
+
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 class CAddress(object):
@@ -376,6 +501,15 @@ class SpendDescription(object):
         self.zkproof = f.read(192)
         self.spendAuthSig = f.read(64)
 
+    def deserialize_from(self, buf, pos):
+        self.cv, pos = deser_uint256_from(buf, pos)
+        self.anchor, pos = deser_uint256_from(buf, pos)
+        self.nullifier, pos = deser_uint256_from(buf, pos)
+        self.rk, pos = deser_uint256_from(buf, pos)
+        self.zkproof, pos = deser_bytes_from(buf, pos, 192)
+        self.spendAuthSig, pos = deser_bytes_from(buf, pos, 64)
+        return pos
+
     def serialize(self):
         r = ""
         r += ser_uint256(self.cv)
@@ -408,6 +542,15 @@ class OutputDescription(object):
         self.outCiphertext = f.read(80)
         self.zkproof = f.read(192)
 
+    def deserialize_from(self, buf, pos):
+        self.cv, pos = deser_uint256_from(buf, pos)
+        self.cmu, pos = deser_uint256_from(buf, pos)
+        self.ephemeralKey, pos = deser_uint256_from(buf, pos)
+        self.encCiphertext, pos = deser_bytes_from(buf, pos, 580)
+        self.outCiphertext, pos = deser_bytes_from(buf, pos, 80)
+        self.zkproof, pos = deser_bytes_from(buf, pos, 192)
+        return pos
+
     def serialize(self):
         r = ""
         r += ser_uint256(self.cv)
@@ -459,6 +602,25 @@ class ZCProof(object):
         self.g_K = deser_g1(f)
         self.g_H = deser_g1(f)
 
+    def deserialize_from(self, buf, pos):
+        def deser_g1(pos):
+            leadingByte = _struct_B.unpack_from(buf, pos)[0]
+            x, pos = deser_bytes_from(buf, pos + 1, 32)
+            return {'y_lsb': leadingByte & 1, 'x': x}, pos
+        def deser_g2(pos):
+            leadingByte = _struct_B.unpack_from(buf, pos)[0]
+            x, pos = deser_bytes_from(buf, pos + 1, 64)
+            return {'y_gt': leadingByte & 1, 'x': x}, pos
+        self.g_A, pos = deser_g1(pos)
+        self.g_A_prime, pos = deser_g1(pos)
+        self.g_B, pos = deser_g2(pos)
+        self.g_B_prime, pos = deser_g1(pos)
+        self.g_C, pos = deser_g1(pos)
+        self.g_C_prime, pos = deser_g1(pos)
+        self.g_K, pos = deser_g1(pos)
+        self.g_H, pos = deser_g1(pos)
+        return pos
+
     def serialize(self):
         def ser_g1(self, p):
             return chr(G1_PREFIX_MASK | p['y_lsb']) + p['x']
@@ -547,6 +709,38 @@ class JSDescription(object):
         for i in range(ZC_NUM_JS_OUTPUTS):
             self.ciphertexts.append(f.read(ZC_NOTECIPHERTEXT_SIZE))
 
+    def deserialize_from(self, buf, pos):
+        self.vpub_old = _struct_q.unpack_from(buf, pos)[0]
+        self.vpub_new = _struct_q.unpack_from(buf, pos + 8)[0]
+        self.anchor, pos = deser_uint256_from(buf, pos + 16)
+
+        self.nullifiers = []
+        for i in range(ZC_NUM_JS_INPUTS):
+            nullifier, pos = deser_uint256_from(buf, pos)
+            self.nullifiers.append(nullifier)
+
+        self.commitments = []
+        for i in range(ZC_NUM_JS_OUTPUTS):
+            commitment, pos = deser_uint256_from(buf, pos)
+            self.commitments.append(commitment)
+
+        self.onetimePubKey, pos = deser_uint256_from(buf, pos)
+        self.randomSeed, pos = deser_uint256_from(buf, pos)
+
+        self.macs = []
+        for i in range(ZC_NUM_JS_INPUTS):
+            mac, pos = deser_uint256_from(buf, pos)
+            self.macs.append(mac)
+
+        self.proof = ZCProof()
+        pos = self.proof.deserialize_from(buf, pos)
+
+        self.ciphertexts = []
+        for i in range(ZC_NUM_JS_OUTPUTS):
+            ciphertext, pos = deser_bytes_from(buf, pos, ZC_NOTECIPHERTEXT_SIZE)
+            self.ciphertexts.append(ciphertext)
+        return pos
+
     def serialize(self):
         r = ""
         r += struct.pack("<q", self.vpub_old)
@@ -580,6 +774,11 @@ class COutPoint(object):
         self.hash = deser_uint256(f)
         self.n = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos):
+        self.hash, pos = deser_uint256_from(buf, pos)
+        self.n = _struct_I.unpack_from(buf, pos)[0]
+        return pos + 4
+
     def serialize(self):
         r = ""
         r += ser_uint256(self.hash)
@@ -605,6 +804,13 @@ class CTxIn(object):
         self.scriptSig = deser_string(f)
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos):
+        self.prevout = COutPoint()
+        pos = self.prevout.deserialize_from(buf, pos)
+        self.scriptSig, pos = deser_string_from(buf, pos)
+        self.nSequence = _struct_I.unpack_from(buf, pos)[0]
+        return pos + 4
+
     def serialize(self):
         r = ""
         r += self.prevout.serialize()
@@ -627,6 +833,11 @@ class CTxOut(object):
         self.nValue = struct.unpack("<q", f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
+    def deserialize_from(self, buf, pos):
+        self.nValue = _struct_q.unpack_from(buf, pos)[0]
+        self.scriptPubKey, pos = deser_string_from(buf, pos + 8)
+        return pos
+
     def serialize(self):
         r = ""
         r += struct.pack("<q", self.nValue)
@@ -639,7 +850,17 @@ class CTxOut(object):
                binascii.hexlify(self.scriptPubKey))
 
 
+# The txid is computed once and cached in sha256/hash.  Assigning one of the
+# serialized fields drops the cache, but changes made through nested objects
+# (tx.vin[0].scriptSig = ..., tx.vout.append(...)) cannot be observed from
+# here, so after those call rehash() to invalidate it.
 class CTransaction(object):
+    hashed_fields = frozenset([
+        "fOverwintered", "nVersion", "nVersionGroupId", "vin", "vout",
+        "nLockTime", "nExpiryHeight", "valueBalance", "shieldedSpends",
+        "shieldedOutputs", "vJoinSplit", "joinSplitPubKey", "joinSplitSig",
+        "bindingSig"])
+
     def __init__(self, tx=None):
         if tx is None:
             self.fOverwintered = True
@@ -713,6 +934,50 @@ class CTransaction(object):
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, pos):
+        header = _struct_I.unpack_from(buf, pos)[0]
+        pos += 4
+        self.fOverwintered = bool(header >> 31)
+        self.nVersion = header & 0x7FFFFFFF
+        if self.fOverwintered:
+            self.nVersionGroupId = _struct_I.unpack_from(buf, pos)[0]
+            pos += 4
+        else:
+            self.nVersionGroupId = 0
+
+        isOverwinterV3 = (self.fOverwintered and
+                          self.nVersionGroupId == OVERWINTER_VERSION_GROUP_ID and
+                          self.nVersion == 3)
+        isSaplingV4 = (self.fOverwintered and
+                       self.nVersionGroupId == SAPLING_VERSION_GROUP_ID and
+                       self.nVersion == 4)
+
+        self.vin, pos = deser_vector_from(buf, pos, CTxIn)
+        self.vout, pos = deser_vector_from(buf, pos, CTxOut)
+        self.nLockTime = _struct_I.unpack_from(buf, pos)[0]
+        pos += 4
+        if isOverwinterV3 or isSaplingV4:
+            self.nExpiryHeight = _struct_I.unpack_from(buf, pos)[0]
+            pos += 4
+
+        if isSaplingV4:
+            self.valueBalance = _struct_q.unpack_from(buf, pos)[0]
+            self.shieldedSpends, pos = deser_vector_from(buf, pos + 8, SpendDescription)
+            self.shieldedOutputs, pos = deser_vector_from(buf, pos, OutputDescription)
+
+        if self.nVersion >= 2:
+            self.vJoinSplit, pos = deser_vector_from(buf, pos, JSDescription)
+            if len(self.vJoinSplit) > 0:
+                self.joinSplitPubKey, pos = deser_uint256_from(buf, pos)
+                self.joinSplitSig, pos = deser_bytes_from(buf, pos, 64)
+
+        if isSaplingV4 and not (len(self.shieldedSpends) == 0 and len(self.shieldedOutputs) == 0):
+            self.bindingSig, pos = deser_bytes_from(buf, pos, 64)
+
+        self.sha256 = None
+        self.hash = None
+        return pos
+
     def serialize(self):
         header = (int(self.fOverwintered)<<31) | self.nVersion
         isOverwinterV3 = (self.fOverwintered and
@@ -744,14 +1009,24 @@ class CTransaction(object):
             r += self.bindingSig
         return r
 
+    def __setattr__(self, name, value):
+        d = self.__dict__
+        if name in self.hashed_fields:
+            d['sha256'] = None
+            d['hash'] = None
+        d[name] = value
+
     def rehash(self):
         self.sha256 = None
         self.calc_sha256()
 
     def calc_sha256(self):
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = hash256(self.serialize())[::-1].encode('hex_codec')
+            h = hash256(self.serialize())
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].encode('hex_codec')
+        elif self.hash is None:
+            self.hash = ser_uint256(self.sha256)[::-1].encode('hex_codec')
 
     def is_valid(self):
         self.calc_sha256()
@@ -779,6 +1054,14 @@ class CTransaction(object):
 
 
 class CBlockHeader(object):
+    # Fields covered by the first 108 bytes of the serialized header, i.e.
+    # everything before nNonce.  Assigning any of these drops the cached
+    # header prefix as well as the cached block hash.
+    prefix_fields = frozenset([
+        "nVersion", "hashPrevBlock", "hashMerkleRoot",
+        "hashFinalSaplingRoot", "nTime", "nBits"])
+    hashed_fields = prefix_fields | frozenset(["nNonce", "nSolution"])
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -819,20 +1102,33 @@ class CBlockHeader(object):
         self.sha256 = None
         self.hash = None
 
-    def serialize(self):
-        r = ""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += ser_uint256(self.hashFinalSaplingRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += ser_uint256(self.nNonce)
-        r += ser_char_vector(self.nSolution)
-        return r
-
-    def calc_sha256(self):
-        if self.sha256 is None:
+    def deserialize_from(self, buf, pos):
+        self.nVersion = _struct_i.unpack_from(buf, pos)[0]
+        self.hashPrevBlock, pos = deser_uint256_from(buf, pos + 4)
+        self.hashMerkleRoot, pos = deser_uint256_from(buf, pos)
+        self.hashFinalSaplingRoot, pos = deser_uint256_from(buf, pos)
+        self.nTime = _struct_I.unpack_from(buf, pos)[0]
+        self.nBits = _struct_I.unpack_from(buf, pos + 4)[0]
+        self.nNonce, pos = deser_uint256_from(buf, pos + 8)
+        self.nSolution, pos = deser_char_vector_from(buf, pos)
+        self.sha256 = None
+        self.hash = None
+        return pos
+
+    def __setattr__(self, name, value):
+        d = self.__dict__
+        if name in self.hashed_fields:
+            d['sha256'] = None
+            d['hash'] = None
+            if name in self.prefix_fields:
+                d['_prefix'] = None
+        d[name] = value
+
+    # The part of the header that is fed to the Equihash personalised
+    # BLAKE2b state; it does not change while solving.
+    def serialize_prefix(self):
+        r = self.__dict__.get('_prefix')
+        if r is None:
             r = ""
             r += struct.pack("<i", self.nVersion)
             r += ser_uint256(self.hashPrevBlock)
@@ -840,10 +1136,24 @@ class CBlockHeader(object):
             r += ser_uint256(self.hashFinalSaplingRoot)
             r += struct.pack("<I", self.nTime)
             r += struct.pack("<I", self.nBits)
-            r += ser_uint256(self.nNonce)
-            r += ser_char_vector(self.nSolution)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = hash256(r)[::-1].encode('hex_codec')
+            self.__dict__['_prefix'] = r
+        return r
+
+    def serialize(self):
+        r = self.serialize_prefix()
+        r += ser_uint256(self.nNonce)
+        r += ser_char_vector(self.nSolution)
+        return r
+
+    # The Equihash input I||V that nSolution solves.
+    def equihash_input(self):
+        return self.serialize_prefix() + ser_uint256(self.nNonce)
+
+    def calc_sha256(self):
+        if self.sha256 is None:
+            h = hash256(CBlockHeader.serialize(self))
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].encode('hex_codec')
 
     def rehash(self):
         self.sha256 = None
@@ -860,11 +1170,17 @@ class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        self._merkle_tree = None
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
+    def deserialize_from(self, buf, pos):
+        pos = super(CBlock, self).deserialize_from(buf, pos)
+        self.vtx, pos = deser_vector_from(buf, pos, CTransaction)
+        return pos
+
     def serialize(self):
         r = ""
         r += super(CBlock, self).serialize()
@@ -872,24 +1188,31 @@ class CBlock(CBlockHeader):
         return r
 
     def calc_merkle_root(self):
-        hashes = []
-        for tx in self.vtx:
+        # Keep the tree between calls, so that appending a transaction (or
+        # replacing one) and asking for the root again only rehashes the
+        # path from the changed leaves up to the root.
+        tree = self._merkle_tree
+        if tree is None or len(tree) > len(self.vtx):
+            tree = self._merkle_tree = MerkleTree()
+        for i, tx in enumerate(self.vtx):
             tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        while len(hashes) > 1:
-            newhashes = []
-            for i in xrange(0, len(hashes), 2):
-                i2 = min(i+1, len(hashes)-1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        return uint256_from_str(hashes[0])
+            if i == len(tree):
+                tree.append(tx.sha256)
+            elif tree.leaf(i) != tx.sha256:
+                tree.replace(i, tx.sha256)
+        return tree.root()
+
+    def merkle_tree(self):
+        """Return the MerkleTree over this block's transactions."""
+        self.calc_merkle_root()
+        return self._merkle_tree
 
     def is_valid(self, n=48, k=5):
         # H(I||...
         digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
-        digest.update(super(CBlock, self).serialize()[:108])
+        digest.update(self.serialize_prefix())
         hash_nonce(digest, self.nNonce)
-        if not gbp_validate(self.nSolution, digest, n, k):
+        if not gbp_validate(digest, self.nSolution, n, k):
             return False
         self.calc_sha256()
         target = uint256_from_compact(self.nBits)
@@ -906,14 +1229,14 @@ class CBlock(CBlockHeader):
         target = uint256_from_compact(self.nBits)
         # H(I||...
         digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
-        digest.update(super(CBlock, self).serialize()[:108])
+        digest.update(self.serialize_prefix())
         self.nNonce = 0
         while True:
             # H(I||V||...
             curr_digest = digest.copy()
             hash_nonce(curr_digest, self.nNonce)
             # (x_1, x_2, ...) = A(I, V, n, k)
-            solns = gbp_basic(curr_digest, n, k)
+            solns = gbp_solve(curr_digest, n, k)
             for soln in solns:
                 assert(gbp_validate(curr_digest, soln, n, k))
                 self.nSolution = soln
@@ -929,6 +1252,197 @@ class CBlock(CBlockHeader):
                self.nNonce, self.nSolution, self.vtx)
 
 
+# MerkleTree: an incremental merkle tree with the same shape as the one
+# bitcoind builds over a block's transactions (the last hash of an odd-sized
+# level is paired with itself).  Every level is kept, so appending or
+# replacing a leaf and querying the root are O(log n), and merkle branches
+# and partial merkle trees (as returned by gettxoutproof) can be read off
+# directly.  Leaves and results are uint256 integers, like tx.sha256.
+class MerkleTree(object):
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        for leaf in leaves:
+            self.append(leaf)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def leaf(self, index):
+        return uint256_from_str(self.levels[0][index])
+
+    def append(self, leaf):
+        index = len(self.levels[0])
+        self.levels[0].append(ser_uint256(leaf))
+        self._update(index)
+        return index
+
+    def replace(self, index, leaf):
+        self.levels[0][index] = ser_uint256(leaf)
+        self._update(index)
+
+    def _update(self, index):
+        height = 0
+        while len(self.levels[height]) > 1:
+            level = self.levels[height]
+            index >>= 1
+            left = level[2*index]
+            right = level[min(2*index+1, len(level)-1)]
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            parent = self.levels[height+1]
+            if index == len(parent):
+                parent.append(hash256(left + right))
+            else:
+                parent[index] = hash256(left + right)
+            height += 1
+
+    def root(self):
+        if len(self.levels[0]) == 0:
+            return 0L
+        return uint256_from_str(self.levels[-1][0])
+
+    def branch(self, index):
+        """Return the sibling hashes from leaf index up to the root."""
+        if not 0 <= index < len(self.levels[0]):
+            raise IndexError("leaf %d out of range (%d)" % (index, len(self)))
+        r = []
+        for level in self.levels[:-1]:
+            r.append(uint256_from_str(level[min(index ^ 1, len(level)-1)]))
+            index >>= 1
+        return r
+
+    def partial_tree(self, indices):
+        """Build the CPartialMerkleTree matching the given leaf indices."""
+        matches = set(indices)
+        n = len(self.levels[0])
+        tree = CPartialMerkleTree()
+        tree.nTransactions = n
+
+        def width(height):
+            return (n + (1 << height) - 1) >> height
+
+        def build(height, pos):
+            first = pos << height
+            last = min((pos+1) << height, n)
+            parent_of_match = any(i in matches for i in xrange(first, last))
+            tree.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                tree.vHash.append(uint256_from_str(self.levels[height][pos]))
+            else:
+                build(height-1, pos*2)
+                if pos*2+1 < width(height-1):
+                    build(height-1, pos*2+1)
+
+        if n > 0:
+            build(len(self.levels)-1, 0)
+        return tree
+
+
+def check_merkle_branch(leaf, branch, index):
+    """Return the merkle root implied by leaf, its branch and its index."""
+    h = ser_uint256(leaf)
+    for sibling in branch:
+        if index & 1:
+            h = hash256(ser_uint256(sibling) + h)
+        else:
+            h = hash256(h + ser_uint256(sibling))
+        index >>= 1
+    return uint256_from_str(h)
+
+
+class CPartialMerkleTree(object):
+    def __init__(self):
+        self.nTransactions = 0
+        self.vHash = []
+        self.vBits = []
+
+    def deserialize(self, f):
+        self.nTransactions = struct.unpack("<I", f.read(4))[0]
+        self.vHash = deser_uint256_vector(f)
+        vBytes = bytearray(deser_string(f))
+        self.vBits = [(vBytes[p / 8] & (1 << (p % 8))) != 0
+                      for p in xrange(len(vBytes) * 8)]
+
+    def serialize(self):
+        vBytes = bytearray((len(self.vBits) + 7) / 8)
+        for p, bit in enumerate(self.vBits):
+            vBytes[p / 8] |= int(bit) << (p % 8)
+        r = ""
+        r += struct.pack("<I", self.nTransactions)
+        r += ser_uint256_vector(self.vHash)
+        r += ser_string(str(vBytes))
+        return r
+
+    def extract_matches(self):
+        """Return (merkle root, [(index, txid), ...]) for the matched txids.
+
+        Raises ValueError if the tree is malformed, mirroring the checks in
+        CPartialMerkleTree::ExtractMatches.
+        """
+        n = self.nTransactions
+        if n == 0 or len(self.vHash) > n or len(self.vBits) < len(self.vHash):
+            raise ValueError("malformed partial merkle tree")
+        height = 0
+        while ((n + (1 << height) - 1) >> height) > 1:
+            height += 1
+        state = {'bits': 0, 'hashes': 0}
+        matches = []
+
+        def width(height):
+            return (n + (1 << height) - 1) >> height
+
+        def extract(height, pos):
+            if state['bits'] >= len(self.vBits):
+                raise ValueError("partial merkle tree overflowed its bits")
+            parent_of_match = self.vBits[state['bits']]
+            state['bits'] += 1
+            if height == 0 or not parent_of_match:
+                if state['hashes'] >= len(self.vHash):
+                    raise ValueError("partial merkle tree overflowed its hashes")
+                h = self.vHash[state['hashes']]
+                state['hashes'] += 1
+                if height == 0 and parent_of_match:
+                    matches.append((pos, h))
+                return ser_uint256(h)
+            left = extract(height-1, pos*2)
+            if pos*2+1 < width(height-1):
+                right = extract(height-1, pos*2+1)
+                if right == left:
+                    raise ValueError("partial merkle tree has duplicate hashes")
+            else:
+                right = left
+            return hash256(left + right)
+
+        root = extract(height, 0)
+        if (state['bits'] + 7) / 8 != (len(self.vBits) + 7) / 8 or \
+                state['hashes'] != len(self.vHash):
+            raise ValueError("partial merkle tree was not fully consumed")
+        return uint256_from_str(root), matches
+
+    def __repr__(self):
+        return "CPartialMerkleTree(nTransactions=%d vHash=%r vBits=%r)" \
+            % (self.nTransactions, self.vHash, self.vBits)
+
+
+class CMerkleBlock(object):
+    def __init__(self, header=None, txn=None):
+        self.header = CBlockHeader() if header is None else CBlockHeader(header)
+        self.txn = CPartialMerkleTree() if txn is None else txn
+
+    def deserialize(self, f):
+        self.header.deserialize(f)
+        self.txn.deserialize(f)
+
+    def serialize(self):
+        r = ""
+        r += self.header.serialize()
+        r += self.txn.serialize()
+        return r
+
+    def __repr__(self):
+        return "CMerkleBlock(header=%r txn=%r)" % (self.header, self.txn)
+
+
 class CUnsignedAlert(object):
     def __init__(self):
         self.nVersion = 1
@@ -1194,6 +1708,9 @@ class msg_tx(object):
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        return self.tx.deserialize_from(buf, pos)
+
     def serialize(self):
         return self.tx.serialize()
 
@@ -1213,6 +1730,9 @@ class msg_block(object):
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def deserialize_from(self, buf, pos):
+        return self.block.deserialize_from(buf, pos)
+
     def serialize(self):
         return self.block.serialize()
 
@@ -1345,6 +1865,12 @@ class msg_headers(object):
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def deserialize_from(self, buf, pos):
+        blocks, pos = deser_vector_from(buf, pos, CBlock)
+        for x in blocks:
+            self.headers.append(CBlockHeader(x))
+        return pos
+
     def serialize(self):
         blocks = [CBlock(x) for x in self.headers]
         return ser_vector(blocks)
@@ -1416,9 +1942,21 @@ class msg_filterclear(object):
 
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
+#
+# The events tests commonly wait for (verack, pong, getdata, inv and
+# reject) are also recorded by deliver() itself, whatever the on_*
+# functions do, and each has a Condition (on mininode_lock) notified when
+# one arrives; the wait_for_* methods wait on these.
 class NodeConnCB(object):
+    events = ("verack", "pong", "getdata", "inv", "reject")
+
     def __init__(self):
         self.verack_received = False
+        self.event_cvs = dict((event, Condition(mininode_lock)) for event in self.events)
+        self.pong_nonces = set()
+        self.getdata_requests = set()
+        self.invs_received = 0
+        self.rejects_received = []
 
     # Derived classes should call this function once to set the message map
     # which associates the derived classes' functions to incoming messages
@@ -1450,6 +1988,44 @@ class NodeConnCB(object):
             except:
                 print "ERROR delivering %r (%s)" % (message,
                                                     sys.exc_info()[0])
+            self.record_event(message)
+            mininode_cv.notify_all()
+
+    def record_event(self, message):
+        command = message.command
+        if command not in self.event_cvs:
+            return
+        if command == "verack":
+            self.verack_received = True
+        elif command == "pong":
+            self.pong_nonces.add(message.nonce)
+        elif command == "getdata":
+            self.getdata_requests.update(inv.hash for inv in message.inv)
+        elif command == "inv":
+            self.invs_received += 1
+        elif command == "reject":
+            self.rejects_received.append(message)
+        self.event_cvs[command].notify_all()
+
+    def wait_for_event(self, event, predicate, timeout=60):
+        return wait_on(self.event_cvs[event], predicate, timeout)
+
+    def wait_for_verack(self, timeout=60):
+        return self.wait_for_event("verack", lambda: self.verack_received, timeout)
+
+    def wait_for_pong(self, nonce, timeout=60):
+        return self.wait_for_event("pong", lambda: nonce in self.pong_nonces, timeout)
+
+    def wait_for_getdata(self, hash, timeout=60):
+        return self.wait_for_event("getdata", lambda: hash in self.getdata_requests, timeout)
+
+    def wait_for_inv(self, count=1, timeout=60):
+        """Wait until count inv messages have been received in total."""
+        return self.wait_for_event("inv", lambda: self.invs_received >= count, timeout)
+
+    def wait_for_reject(self, count=1, timeout=60):
+        """Wait until count reject messages have been received in total."""
+        return self.wait_for_event("reject", lambda: len(self.rejects_received) >= count, timeout)
 
     def on_version(self, conn, message):
         if message.nVersion >= 209:
@@ -1491,7 +2067,55 @@ class NodeConnCB(object):
 
 # The actual NodeConn class
 # This class provides an interface for a p2p connection to a specified node
+# NetworkWakeup: the read end of a pipe that is polled alongside the
+# connections, so that the network thread returns from poll() as soon as
+# another thread queues a message or asks for a disconnect, instead of
+# waiting for the poll timeout.  The pipe is opened by network_wakeup() when
+# the first connection or network thread needs it, not at import.
+class NetworkWakeup(asyncore.file_dispatcher):
+    def __init__(self):
+        (r, w) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map={})
+        os.close(r)
+        self.wfd = w
+        flags = fcntl.fcntl(w, fcntl.F_GETFL)
+        fcntl.fcntl(w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.wfd, "x")
+        except OSError as e:
+            # A full pipe already guarantees a wakeup.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except OSError:
+            pass
+
+mininode_wakeup = None
+mininode_wakeup_lock = Lock()
+
+def network_wakeup():
+    global mininode_wakeup
+    with mininode_wakeup_lock:
+        if mininode_wakeup is None:
+            mininode_wakeup = NetworkWakeup()
+        return mininode_wakeup
+
+
 class NodeConn(asyncore.dispatcher):
+    # How much to read from the socket per readable event.
+    read_size = 65536
+
     messagemap = {
         "version": msg_version,
         "verack": msg_verack,
@@ -1523,8 +2147,13 @@ class NodeConn(asyncore.dispatcher):
         self.dstaddr = dstaddr
         self.dstport = dstport
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sendbuf = ""
-        self.recvbuf = ""
+        # Framed messages waiting to be written, and how much of the first
+        # one has already been sent.  deque.append/popleft are atomic, so
+        # any thread may queue messages without taking mininode_lock.
+        self.sendqueue = deque()
+        self.sendoffset = 0
+        self.recvbuf = bytearray()
+        self.recvpos = 0
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -1532,6 +2161,7 @@ class NodeConn(asyncore.dispatcher):
         self.network = net
         self.cb = callback
         self.disconnect = False
+        self.wakeup = network_wakeup()
 
         # stuff version msg into sendbuf
         vt = msg_version(protocol_version)
@@ -1560,17 +2190,21 @@ class NodeConn(asyncore.dispatcher):
         self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
                             % (self.dstaddr, self.dstport))
         self.state = "closed"
-        self.recvbuf = ""
-        self.sendbuf = ""
+        self.recvbuf = bytearray()
+        self.recvpos = 0
+        self.sendqueue.clear()
+        self.sendoffset = 0
         try:
             self.close()
         except:
             pass
         self.cb.on_close(self)
+        with mininode_lock:
+            mininode_cv.notify_all()
 
     def handle_read(self):
         try:
-            t = self.recv(8192)
+            t = self.recv(self.read_size)
             if len(t) > 0:
                 self.recvbuf += t
                 self.got_data()
@@ -1581,61 +2215,83 @@ class NodeConn(asyncore.dispatcher):
         return True
 
     def writable(self):
-        with mininode_lock:
-            length = len(self.sendbuf)
-        return (length > 0)
+        return len(self.sendqueue) > 0
 
     def handle_write(self):
-        with mininode_lock:
+        # Only the network thread pops from the queue.
+        while self.sendqueue:
+            data = self.sendqueue[0]
             try:
-                sent = self.send(self.sendbuf)
+                sent = self.send(buffer(data, self.sendoffset))
             except:
                 self.handle_close()
                 return
-            self.sendbuf = self.sendbuf[sent:]
+            self.sendoffset += sent
+            if self.sendoffset < len(data):
+                return
+            self.sendqueue.popleft()
+            self.sendoffset = 0
 
     def got_data(self):
-        while True:
-            if len(self.recvbuf) < 4:
-                return
-            if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                raise ValueError("got garbage %r" % (self.recvbuf,))
-            if self.ver_recv < 209:
-                if len(self.recvbuf) < 4 + 12 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split("\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = None
-                if len(self.recvbuf) < 4 + 12 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4:4+12+4+msglen]
-                self.recvbuf = self.recvbuf[4+12+4+msglen:]
-            else:
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
+        # recvbuf is consumed from recvpos onwards; parsed messages are not
+        # sliced off one by one (which is quadratic for a burst of small
+        # messages), the buffer is compacted once per call instead.
+        buf = self.recvbuf
+        try:
+            while True:
+                pos = self.recvpos
+                avail = len(buf) - pos
+                if avail < 4:
                     return
-                command = self.recvbuf[4:4+12].split("\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                if buf[pos:pos+4] != self.MAGIC_BYTES[self.network]:
+                    raise ValueError("got garbage %r" % (buf[pos:],))
+                if self.ver_recv < 209:
+                    if avail < 4 + 12 + 4:
+                        return
+                    command = str(buf[pos+4:pos+4+12]).split("\x00", 1)[0]
+                    msglen = _struct_i.unpack_from(buf, pos+4+12)[0]
+                    checksum = None
+                    if avail < 4 + 12 + 4 + msglen:
+                        return
+                    msg = str(buf[pos+4+12+4:pos+4+12+4+msglen])
+                    self.recvpos = pos + 4 + 12 + 4 + msglen
+                else:
+                    if avail < 4 + 12 + 4 + 4:
+                        return
+                    command = str(buf[pos+4:pos+4+12]).split("\x00", 1)[0]
+                    msglen = _struct_i.unpack_from(buf, pos+4+12)[0]
+                    checksum = str(buf[pos+4+12+4:pos+4+12+4+4])
+                    if avail < 4 + 12 + 4 + 4 + msglen:
+                        return
+                    msg = str(buf[pos+4+12+4+4:pos+4+12+4+4+msglen])
+                    th = sha256(msg)
+                    h = sha256(th)
+                    if checksum != h[:4]:
+                        raise ValueError("got bad checksum %r" % (buf[pos:],))
+                    self.recvpos = pos + 4 + 12 + 4 + 4 + msglen
+                if command in self.messagemap:
+                    t = self.messagemap[command]()
+                    if hasattr(t, 'deserialize_from'):
+                        t.deserialize_from(msg, 0)
+                    else:
+                        f = cStringIO.StringIO(msg)
+                        t.deserialize(f)
+                    self.got_message(t)
+                else:
+                    self.show_debug_msg("Unknown command: '%s' %r" % (command, msg))
+                if self.recvbuf is not buf:
+                    # The connection was closed while delivering.
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum %r" % (self.recvbuf,))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-            if command in self.messagemap:
-                f = cStringIO.StringIO(msg)
-                t = self.messagemap[command]()
-                t.deserialize(f)
-                self.got_message(t)
-            else:
-                self.show_debug_msg("Unknown command: '%s' %r" % (command, msg))
+        finally:
+            if self.recvbuf is buf and self.recvpos > 0:
+                del buf[:self.recvpos]
+                self.recvpos = 0
 
     def send_message(self, message, pushbuf=False):
         if self.state != "connected" and not pushbuf:
             return
-        self.show_debug_msg("Send %r" % (message,))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.show_debug_msg("Send %r" % (message,))
         command = message.command
         data = message.serialize()
         tmsg = self.MAGIC_BYTES[self.network]
@@ -1647,9 +2303,9 @@ class NodeConn(asyncore.dispatcher):
             h = sha256(th)
             tmsg += h[:4]
         tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
-            self.last_sent = time.time()
+        self.sendqueue.append(tmsg)
+        self.last_sent = time.time()
+        self.wakeup.wake()
 
     def got_message(self, message):
         if message.command == "version":
@@ -1657,15 +2313,18 @@ class NodeConn(asyncore.dispatcher):
                 self.messagemap['ping'] = msg_ping_prebip31
         if self.last_sent + 30 * 60 < time.time():
             self.send_message(self.messagemap['ping']())
-        self.show_debug_msg("Recv %r" % (message,))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.show_debug_msg("Recv %r" % (message,))
         self.cb.deliver(self, message)
 
     def disconnect_node(self):
         self.disconnect = True
+        self.wakeup.wake()
 
 
 class NetworkThread(Thread):
     def run(self):
+        wakeup = network_wakeup()
         while mininode_socket_map:
             # We check for whether to disconnect outside of the asyncore
             # loop to workaround the behavior of asyncore when using
@@ -1675,7 +2334,11 @@ class NetworkThread(Thread):
                 if obj.disconnect:
                     disconnected.append(obj)
             [ obj.handle_close() for obj in disconnected ]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+            # Poll the wakeup pipe alongside the connections, but keep it
+            # out of mininode_socket_map so it doesn't keep this loop alive.
+            socket_map = dict(mininode_socket_map)
+            socket_map[wakeup.fileno()] = wakeup
+            asyncore.loop(0.1, use_poll=True, map=socket_map, count=1)
 
 
 # An exception we can raise if we detect a potential disconnect
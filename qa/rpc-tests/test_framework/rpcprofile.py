@@ -0,0 +1,119 @@
+# rpcprofile.py - profiling of the RPC calls a test makes
+#
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php .
+#
+
+#
+# Enabled with the --profile-rpc option of BitcoinTestFramework.
+#
+# Every AuthServiceProxy request is recorded with the node it went to, the
+# method, its latency and the request/response sizes, as well as the time
+# spent in sync_blocks/sync_mempools and in each phase of the test (setup,
+# run_test, shutdown).
+#
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+import authproxy
+import util
+
+
+class RPCProfiler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.syncs = []
+        self.phases = []
+        self.current_phase = None
+        # Name nodes by their RPC port where we can
+        self.node_names = dict((util.rpc_port(i), "node%d" % i) for i in range(util.MAX_NODES))
+
+    def start(self):
+        authproxy.call_observer = self.record_call
+        util.sync_observer = self.record_sync
+
+    def stop(self):
+        authproxy.call_observer = None
+        util.sync_observer = None
+
+    @contextmanager
+    def phase(self, name):
+        """Account the time spent in the with-block, and the calls made, to name."""
+        self.current_phase = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+            self.current_phase = None
+
+    def node_name(self, service_url):
+        url = urlparse.urlparse(service_url)
+        return self.node_names.get(url.port) or "%s:%s" % (url.hostname, url.port)
+
+    def record_call(self, service_url, method, seconds, request_bytes, response_bytes):
+        with self.lock:
+            self.calls.append({"phase": self.current_phase,
+                               "node": self.node_name(service_url),
+                               "method": method,
+                               "seconds": seconds,
+                               "request_bytes": request_bytes,
+                               "response_bytes": response_bytes})
+
+    def record_sync(self, name, seconds):
+        with self.lock:
+            self.syncs.append({"phase": self.current_phase, "name": name, "seconds": seconds})
+
+    def methods(self):
+        """Per method totals, most time consuming first."""
+        totals = {}
+        for call in self.calls:
+            t = totals.setdefault(call["method"], {"method": call["method"], "count": 0,
+                                                   "seconds": 0.0, "max_seconds": 0.0,
+                                                   "request_bytes": 0, "response_bytes": 0})
+            t["count"] += 1
+            t["seconds"] += call["seconds"]
+            t["max_seconds"] = max(t["max_seconds"], call["seconds"])
+            t["request_bytes"] += call["request_bytes"]
+            t["response_bytes"] += call["response_bytes"]
+        return sorted(totals.values(), key=lambda t: -t["seconds"])
+
+    def report(self):
+        return {"phases": [ {"name": name, "seconds": seconds} for (name, seconds) in self.phases ],
+                "sync_seconds": sum(sync["seconds"] for sync in self.syncs),
+                "rpc_seconds": sum(call["seconds"] for call in self.calls),
+                "methods": self.methods(),
+                "syncs": self.syncs,
+                "calls": self.calls}
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+
+    def print_summary(self, top=10):
+        report = self.report()
+        print("%-12s %10s" % ("PHASE", "SECONDS"))
+        for phase in report["phases"]:
+            print("%-12s %10.2f" % (phase["name"], phase["seconds"]))
+        print("%-12s %10.2f (%d calls)" % ("in sync_*", report["sync_seconds"], len(self.syncs)))
+        print("%-12s %10.2f (%d calls)" % ("in RPC", report["rpc_seconds"], len(self.calls)))
+        print("")
+        print("%-30s %6s %10s %10s %10s %12s" % ("METHOD", "CALLS", "TOTAL s", "MEAN ms", "MAX ms", "RESP BYTES"))
+        for t in report["methods"][:top]:
+            print("%-30s %6d %10.2f %10.1f %10.1f %12d" % (t["method"], t["count"], t["seconds"],
+                                                         1000 * t["seconds"] / t["count"],
+                                                         1000 * t["max_seconds"], t["response_bytes"]))
+        print("")
+        print("%-30s %-16s %-10s %10s %12s" % ("SLOWEST CALLS", "NODE", "PHASE", "ms", "RESP BYTES"))
+        for call in sorted(self.calls, key=lambda call: -call["seconds"])[:top]:
+            print("%-30s %-16s %-10s %10.1f %12d" % (call["method"], call["node"], call["phase"],
+                                                    1000 * call["seconds"], call["response_bytes"]))
@@ -9,12 +9,13 @@
 
 """Scripts
 
-Functionality to build scripts, as well as SignatureHash().
+Functionality to build scripts, as well as SignatureHash() and SigHashCache.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from test_framework.mininode import CTransaction, CTxOut, hash256
+from test_framework.mininode import CTransaction, CTxOut, hash256, ser_string, \
+    ser_uint256, SAPLING_VERSION_GROUP_ID
 
 import sys
 bchr = chr
@@ -24,8 +25,12 @@ if sys.version > '3':
     bchr = lambda x: bytes([x])
     bord = lambda x: x
 
+import re
 import struct
 import binascii
+import hashlib
+
+from pyblake2 import blake2b
 
 from test_framework import bignum
 
@@ -695,62 +700,128 @@ class CScript(bytes):
             # returns a bytes instance even when subclassed.
             return super(CScript, cls).__new__(cls, b''.join(coerce_iterable(value)))
 
-    def raw_iter(self):
-        """Raw iteration
+    # Parsed forms of the script, filled in on first use by _tokens() and
+    # _cooked(). Scripts are immutable, so they never go stale.
+    _parsed = None
+    _cooked_ops = None
 
-        Yields tuples of (opcode, data, sop_idx) so that the different possible
-        PUSHDATA encodings can be accurately distinguished, as well as
-        determining the exact opcode byte indexes. (sop_idx)
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # Pickle the bytes only, not the parsed forms
+        return (CScript, (bytes(self),))
+
+    def _tokens(self):
+        """The parsed script, cached
+
+        Returns (tokens, err): a tuple of the (opcode, data, sop_idx) tuples
+        raw_iter() yields, and the CScriptInvalidError to raise after them,
+        or None.
         """
+        parsed = self._parsed
+        if parsed is not None:
+            return parsed
+
+        tokens = []
+        err = None
+        buf = bytearray(self)
+        n = len(buf)
         i = 0
-        while i < len(self):
+        while i < n:
             sop_idx = i
-            opcode = bord(self[i])
+            opcode = buf[i]
             i += 1
 
             if opcode > OP_PUSHDATA4:
-                yield (opcode, None, sop_idx)
+                tokens.append((opcode, None, sop_idx))
+                continue
+
+            if opcode < OP_PUSHDATA1:
+                datasize = opcode
+
+            elif opcode == OP_PUSHDATA1:
+                if i >= n:
+                    err = CScriptInvalidError('PUSHDATA1: missing data length')
+                    break
+                datasize = buf[i]
+                i += 1
+
+            elif opcode == OP_PUSHDATA2:
+                if i + 1 >= n:
+                    err = CScriptInvalidError('PUSHDATA2: missing data length')
+                    break
+                datasize = buf[i] + (buf[i+1] << 8)
+                i += 2
+
             else:
-                datasize = None
-                pushdata_type = None
+                if i + 3 >= n:
+                    err = CScriptInvalidError('PUSHDATA4: missing data length')
+                    break
+                datasize = buf[i] + (buf[i+1] << 8) + (buf[i+2] << 16) + (buf[i+3] << 24)
+                i += 4
+
+            data = bytes(self[i:i+datasize])
+
+            # Check for truncation
+            if len(data) < datasize:
                 if opcode < OP_PUSHDATA1:
                     pushdata_type = 'PUSHDATA(%d)' % opcode
-                    datasize = opcode
-
-                elif opcode == OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA1'
-                    if i >= len(self):
-                        raise CScriptInvalidError('PUSHDATA1: missing data length')
-                    datasize = bord(self[i])
-                    i += 1
-
-                elif opcode == OP_PUSHDATA2:
-                    pushdata_type = 'PUSHDATA2'
-                    if i + 1 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA2: missing data length')
-                    datasize = bord(self[i]) + (bord(self[i+1]) << 8)
-                    i += 2
-
-                elif opcode == OP_PUSHDATA4:
-                    pushdata_type = 'PUSHDATA4'
-                    if i + 3 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA4: missing data length')
-                    datasize = bord(self[i]) + (bord(self[i+1]) << 8) + (bord(self[i+2]) << 16) + (bord(self[i+3]) << 24)
-                    i += 4
-
                 else:
-                    assert False # shouldn't happen
+                    pushdata_type = OPCODE_NAMES[opcode][3:]
+                err = CScriptTruncatedPushDataError('%s: truncated data' % pushdata_type, data)
+                break
+
+            i += datasize
+            tokens.append((opcode, data, sop_idx))
+
+        parsed = (tuple(tokens), err)
+        self._parsed = parsed
+        return parsed
 
+    @staticmethod
+    def _iter_then_raise(items, err):
+        for item in items:
+            yield item
+        raise err
 
-                data = bytes(self[i:i+datasize])
+    def raw_iter(self):
+        """Raw iteration
 
-                # Check for truncation
-                if len(data) < datasize:
-                    raise CScriptTruncatedPushDataError('%s: truncated data' % pushdata_type, data)
+        Yields tuples of (opcode, data, sop_idx) so that the different possible
+        PUSHDATA encodings can be accurately distinguished, as well as
+        determining the exact opcode byte indexes. (sop_idx)
 
-                i += datasize
+        The script is parsed once; invalid scripts raise CScriptInvalidError
+        after the opcodes before the invalid one.
+        """
+        (tokens, err) = self._tokens()
+        if err is None:
+            return iter(tokens)
+        return self._iter_then_raise(tokens, err)
+
+    def _cooked(self):
+        """The values __iter__() yields, cached like _tokens()"""
+        cooked = self._cooked_ops
+        if cooked is not None:
+            return cooked
+        cooked = []
+        for (opcode, data, sop_idx) in self._tokens()[0]:
+            if data is not None:
+                cooked.append(data)
+            else:
+                opcode = CScriptOp(opcode)
 
-                yield (opcode, data, sop_idx)
+                if opcode.is_small_int():
+                    cooked.append(opcode.decode_op_n())
+                else:
+                    cooked.append(opcode)
+        cooked = tuple(cooked)
+        self._cooked_ops = cooked
+        return cooked
 
     def __iter__(self):
         """'Cooked' iteration
@@ -761,16 +832,10 @@ class CScript(bytes):
         See raw_iter() if you need to distinguish the different possible
         PUSHDATA encodings.
         """
-        for (opcode, data, sop_idx) in self.raw_iter():
-            if data is not None:
-                yield data
-            else:
-                opcode = CScriptOp(opcode)
-
-                if opcode.is_small_int():
-                    yield opcode.decode_op_n()
-                else:
-                    yield CScriptOp(opcode)
+        err = self._tokens()[1]
+        if err is None:
+            return iter(self._cooked())
+        return self._iter_then_raise(self._cooked(), err)
 
     def __repr__(self):
         # For Python3 compatibility add b before strings so testcases don't
@@ -781,23 +846,12 @@ class CScript(bytes):
             else:
                 return repr(o)
 
-        ops = []
-        i = iter(self)
-        while True:
-            op = None
-            try:
-                op = _repr(next(i))
-            except CScriptTruncatedPushDataError as err:
-                op = '%s...<ERROR: %s>' % (_repr(err.data), err)
-                break
-            except CScriptInvalidError as err:
-                op = '<ERROR: %s>' % err
-                break
-            except StopIteration:
-                break
-            finally:
-                if op is not None:
-                    ops.append(op)
+        ops = [_repr(op) for op in self._cooked()]
+        err = self._tokens()[1]
+        if isinstance(err, CScriptTruncatedPushDataError):
+            ops.append('%s...<ERROR: %s>' % (_repr(err.data), err))
+        elif err is not None:
+            ops.append('<ERROR: %s>' % err)
 
         return "CScript([%s])" % ', '.join(ops)
 
@@ -806,16 +860,18 @@ class CScript(bytes):
 
         fAccurate - Accurately count CHECKMULTISIG, see BIP16 for details.
 
+        Like the consensus code, counting stops at the first invalid opcode.
+
         Note that this is consensus-critical.
         """
         n = 0
         lastOpcode = OP_INVALIDOPCODE
-        for (opcode, data, sop_idx) in self.raw_iter():
-            if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+        for (opcode, data, sop_idx) in self._tokens()[0]:
+            if opcode == OP_CHECKSIG or opcode == OP_CHECKSIGVERIFY:
                 n += 1
-            elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+            elif opcode == OP_CHECKMULTISIG or opcode == OP_CHECKMULTISIGVERIFY:
                 if fAccurate and (OP_1 <= lastOpcode <= OP_16):
-                    n += opcode.decode_op_n()
+                    n += CScriptOp(lastOpcode).decode_op_n()
                 else:
                     n += 20
             lastOpcode = opcode
@@ -829,6 +885,9 @@ SIGHASH_ANYONECANPAY = 0x80
 
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
+    if sig and sig not in script and script._tokens()[1] is None:
+        # Nothing to delete
+        return script
     r = b''
     last_sop_idx = sop_idx = 0
     skip = True
@@ -845,6 +904,54 @@ def FindAndDelete(script, sig):
     return CScript(r)
 
 
+# Any of OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY
+_sigop_bytes = re.compile(b'[\xac-\xaf]')
+
+def _legacy_sigop_count(script):
+    """CScript(script).GetSigOpCount(False), skipping over pushed data
+    without parsing the script into opcodes"""
+    if _sigop_bytes.search(script) is None:
+        return 0
+    buf = bytearray(script)
+    n = len(buf)
+    i = 0
+    count = 0
+    while i < n:
+        opcode = buf[i]
+        i += 1
+        if opcode < OP_PUSHDATA1:
+            i += opcode
+        elif opcode == OP_PUSHDATA1:
+            if i >= n:
+                break
+            i += 1 + buf[i]
+        elif opcode == OP_PUSHDATA2:
+            if i + 1 >= n:
+                break
+            i += 2 + buf[i] + (buf[i+1] << 8)
+        elif opcode == OP_PUSHDATA4:
+            if i + 3 >= n:
+                break
+            i += 4 + buf[i] + (buf[i+1] << 8) + (buf[i+2] << 16) + (buf[i+3] << 24)
+        elif opcode == OP_CHECKSIG or opcode == OP_CHECKSIGVERIFY:
+            count += 1
+        elif opcode == OP_CHECKMULTISIG or opcode == OP_CHECKMULTISIGVERIFY:
+            count += 20
+    return count
+
+
+def GetLegacySigOpCount(tx):
+    """Sigops in the scriptSigs and scriptPubKeys of tx, see GetLegacySigOpCount()"""
+    return (sum(_legacy_sigop_count(txin.scriptSig) for txin in tx.vin) +
+            sum(_legacy_sigop_count(txout.scriptPubKey) for txout in tx.vout))
+
+
+def GetBlockSigOpCount(block):
+    """Legacy sigop count of all the transactions of block, as limited by
+    MAX_BLOCK_SIGOPS"""
+    return sum(GetLegacySigOpCount(tx) for tx in block.vtx)
+
+
 def SignatureHash(script, txTo, inIdx, hashtype):
     """Consensus-correct SignatureHash
 
@@ -894,3 +1001,198 @@ def SignatureHash(script, txTo, inIdx, hashtype):
     hash = hash256(s)
 
     return (hash, None)
+
+
+def _ser_compact_size(n):
+    if n < 253:
+        return struct.pack(b"<B", n)
+    elif n < 0x10000:
+        return struct.pack(b"<BH", 253, n)
+    elif n < 0x100000000:
+        return struct.pack(b"<BI", 254, n)
+    return struct.pack(b"<BQ", 255, n)
+
+
+def _blake2b_256(data, person):
+    return blake2b(data, digest_size=32, person=person).digest()
+
+
+class SigHashCache(object):
+    """Signature hashes of one transaction, for signing many of its inputs
+
+    SignatureHash() copies and re-serializes the whole transaction for every
+    input, which makes signing all the inputs of a large transaction
+    quadratic. SigHashCache serializes the inputs, outputs and the rest of the
+    transaction once, and builds the preimage of each input by splicing the
+    signed input in between the blanked ones. The SHA256 state over the
+    inputs before it is kept, so consecutive inputs share that work.
+
+    OverwinterSignatureHash() computes the ZIP-143 (Overwinter) and ZIP-243
+    (Sapling) digest, with hashPrevouts, hashSequence, hashOutputs and the
+    shielded parts computed once per transaction.
+
+    The transaction must not be modified while the cache is in use, except
+    for scriptSigs, which no signature hash covers.
+    """
+
+    def __init__(self, txTo):
+        self.tx = txTo
+        header = (int(txTo.fOverwintered) << 31) | txTo.nVersion
+        self._head = struct.pack(b"<I", header)
+        if txTo.fOverwintered:
+            self._head += struct.pack(b"<I", txTo.nVersionGroupId)
+
+        self._prevouts = [txin.prevout.serialize() for txin in txTo.vin]
+        self._sequences = [struct.pack(b"<I", txin.nSequence) for txin in txTo.vin]
+        self._outputs = [txout.serialize() for txout in txTo.vout]
+
+        # Everything after the outputs: the tx with no inputs and outputs,
+        # minus its header and the two empty vectors.
+        tail = CTransaction()
+        tail.__dict__.update(txTo.__dict__)
+        tail.vin = []
+        tail.vout = []
+        self._tail = tail.serialize()[len(self._head) + 2:]
+
+        self._all_outputs = _ser_compact_size(len(self._outputs)) + b''.join(self._outputs)
+        self._script_codes = {}
+        self._blanks = {}
+        self._zip_hashes = None
+
+    def _script_code(self, script):
+        try:
+            return self._script_codes[script]
+        except KeyError:
+            code = ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+            self._script_codes[script] = code
+            return code
+
+    def _blanked_inputs(self, keep_sequence):
+        """(blob, offsets, midstates) of the inputs with empty scriptSigs
+
+        The inputs are concatenated in blob, input i starting at offsets[i].
+        midstates[i] is the SHA256 state after the header and the inputs
+        before input i, and is filled in on demand.
+        """
+        try:
+            return self._blanks[keep_sequence]
+        except KeyError:
+            pass
+        zero = struct.pack(b"<I", 0)
+        if keep_sequence:
+            blanks = [p + b'\x00' + seq for (p, seq) in zip(self._prevouts, self._sequences)]
+        else:
+            blanks = [p + b'\x00' + zero for p in self._prevouts]
+        offsets = [0]
+        for blank in blanks:
+            offsets.append(offsets[-1] + len(blank))
+        start = hashlib.sha256(self._head + _ser_compact_size(len(blanks)))
+        entry = (b''.join(blanks), offsets, [start])
+        self._blanks[keep_sequence] = entry
+        return entry
+
+    def SignatureHash(self, script, inIdx, hashtype):
+        """Same as SignatureHash(script, self.tx, inIdx, hashtype)"""
+        HASH_ONE = b'\x01' + b'\x00' * 31
+
+        txTo = self.tx
+        if inIdx >= len(txTo.vin):
+            return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+
+        basetype = hashtype & 0x1f
+        if basetype == SIGHASH_NONE:
+            outputs = b'\x00'
+        elif basetype == SIGHASH_SINGLE:
+            if inIdx >= len(txTo.vout):
+                return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
+            outputs = (_ser_compact_size(inIdx + 1) + CTxOut().serialize() * inIdx +
+                       self._outputs[inIdx])
+        else:
+            outputs = self._all_outputs
+
+        signed = self._prevouts[inIdx] + self._script_code(script) + self._sequences[inIdx]
+        suffix = outputs + self._tail + struct.pack(b"<I", hashtype & 0xffffffff)
+
+        if hashtype & SIGHASH_ANYONECANPAY:
+            h = hashlib.sha256(self._head + b'\x01' + signed + suffix)
+        else:
+            keep_sequence = basetype not in (SIGHASH_NONE, SIGHASH_SINGLE)
+            (blob, offsets, midstates) = self._blanked_inputs(keep_sequence)
+            while len(midstates) <= inIdx:
+                i = len(midstates) - 1
+                midstate = midstates[i].copy()
+                midstate.update(blob[offsets[i]:offsets[i + 1]])
+                midstates.append(midstate)
+            h = midstates[inIdx].copy()
+            h.update(signed)
+            h.update(blob[offsets[inIdx + 1]:])
+            h.update(suffix)
+
+        return (hashlib.sha256(h.digest()).digest(), None)
+
+    def _overwinter_hashes(self):
+        if self._zip_hashes is None:
+            txTo = self.tx
+            hashes = {}
+            hashes['prevouts'] = _blake2b_256(b''.join(self._prevouts), b'ZcashPrevoutHash')
+            hashes['sequence'] = _blake2b_256(b''.join(self._sequences), b'ZcashSequencHash')
+            hashes['outputs'] = _blake2b_256(b''.join(self._outputs), b'ZcashOutputsHash')
+            hashes['joinsplits'] = b'\x00' * 32
+            if txTo.vJoinSplit:
+                hashes['joinsplits'] = _blake2b_256(
+                    b''.join(js.serialize() for js in txTo.vJoinSplit) +
+                    ser_uint256(txTo.joinSplitPubKey), b'ZcashJSplitsHash')
+            hashes['spends'] = b'\x00' * 32
+            if txTo.shieldedSpends:
+                # Without the spendAuthSig
+                hashes['spends'] = _blake2b_256(
+                    b''.join(spend.serialize()[:-64] for spend in txTo.shieldedSpends),
+                    b'ZcashSSpendsHash')
+            hashes['shielded_outputs'] = b'\x00' * 32
+            if txTo.shieldedOutputs:
+                hashes['shielded_outputs'] = _blake2b_256(
+                    b''.join(output.serialize() for output in txTo.shieldedOutputs),
+                    b'ZcashSOutputHash')
+            self._zip_hashes = hashes
+        return self._zip_hashes
+
+    def OverwinterSignatureHash(self, script, inIdx, hashtype, amount, consensusBranchId):
+        """ZIP-143/243 signature hash of input inIdx
+
+        The scriptCode is hashed as given. Pass inIdx=None for the hash
+        signed by joinSplitSig, which covers no input.
+        """
+        txTo = self.tx
+        if not txTo.fOverwintered:
+            raise ValueError("not an Overwinter or Sapling transaction")
+        if inIdx is not None and inIdx >= len(txTo.vin):
+            raise ValueError("inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+        sapling = txTo.nVersionGroupId == SAPLING_VERSION_GROUP_ID
+        hashes = self._overwinter_hashes()
+        zero = b'\x00' * 32
+
+        basetype = hashtype & 0x1f
+        anyonecanpay = hashtype & SIGHASH_ANYONECANPAY
+        hashPrevouts = zero if anyonecanpay else hashes['prevouts']
+        hashSequence = zero
+        if not anyonecanpay and basetype not in (SIGHASH_SINGLE, SIGHASH_NONE):
+            hashSequence = hashes['sequence']
+        hashOutputs = zero
+        if basetype not in (SIGHASH_SINGLE, SIGHASH_NONE):
+            hashOutputs = hashes['outputs']
+        elif basetype == SIGHASH_SINGLE and inIdx is not None and inIdx < len(txTo.vout):
+            hashOutputs = _blake2b_256(self._outputs[inIdx], b'ZcashOutputsHash')
+
+        s = self._head + hashPrevouts + hashSequence + hashOutputs + hashes['joinsplits']
+        if sapling:
+            s += hashes['spends'] + hashes['shielded_outputs']
+        s += struct.pack(b"<II", txTo.nLockTime, txTo.nExpiryHeight)
+        if sapling:
+            s += struct.pack(b"<q", txTo.valueBalance)
+        s += struct.pack(b"<I", hashtype & 0xffffffff)
+        if inIdx is not None:
+            s += (self._prevouts[inIdx] + ser_string(script) + struct.pack(b"<q", amount) +
+                  self._sequences[inIdx])
+
+        person = b'ZcashSigHash' + struct.pack(b"<I", consensusBranchId)
+        return _blake2b_256(s, person)
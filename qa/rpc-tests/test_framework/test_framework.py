@@ -9,15 +9,18 @@
 import os
 import sys
 
+import json
 import shutil
 import tempfile
 import traceback
 
-from authproxy import JSONRPCException
+from authproxy import AuthServiceProxy, JSONRPCException
+from rpcprofile import RPCProfiler
 from util import assert_equal, check_json_precision, \
     initialize_chain, initialize_chain_clean, \
     start_nodes, connect_nodes_bi, stop_nodes, \
-    sync_blocks, sync_mempools, wait_bitcoinds
+    sync_blocks, sync_mempools, wait_bitcoinds, \
+    materialize_datadir, wait_rpc_down
 
 
 class BitcoinTestFramework(object):
@@ -99,6 +102,11 @@ class BitcoinTestFramework(object):
                           help="Root directory for datadirs")
         parser.add_option("--tracerpc", dest="trace_rpc", default=False, action="store_true",
                           help="Print out all RPC calls as they are made")
+        parser.add_option("--profile-rpc", dest="profile_rpc", default=False, action="store_true",
+                          help="Record every RPC call and the time spent in each test phase")
+        parser.add_option("--profile-file", dest="profile_file",
+                          default=os.path.basename(sys.argv[0]) + ".rpc-profile.json",
+                          help="Where --profile-rpc writes its JSON report (default: %default)")
         self.add_options(parser)
         (self.options, self.args) = parser.parse_args()
 
@@ -110,15 +118,21 @@ class BitcoinTestFramework(object):
 
         check_json_precision()
 
+        profiler = RPCProfiler()
+        if self.options.profile_rpc:
+            profiler.start()
+
         success = False
         try:
             if not os.path.isdir(self.options.tmpdir):
                 os.makedirs(self.options.tmpdir)
-            self.setup_chain()
+            with profiler.phase("setup"):
+                self.setup_chain()
 
-            self.setup_network()
+                self.setup_network()
 
-            self.run_test()
+            with profiler.phase("run_test"):
+                self.run_test()
 
             success = True
 
@@ -134,11 +148,18 @@ class BitcoinTestFramework(object):
 
         if not self.options.noshutdown:
             print("Stopping nodes")
-            stop_nodes(self.nodes)
-            wait_bitcoinds()
+            with profiler.phase("shutdown"):
+                stop_nodes(self.nodes)
+                wait_bitcoinds()
         else:
             print("Note: komdodods were not stopped and may still be running")
 
+        if self.options.profile_rpc:
+            profiler.stop()
+            profiler.write(self.options.profile_file)
+            profiler.print_summary()
+            print("RPC profile written to " + self.options.profile_file)
+
         if not self.options.nocleanup and not self.options.noshutdown:
             print("Cleaning up")
             shutil.rmtree(self.options.tmpdir)
@@ -170,6 +191,10 @@ class ComparisonTestFramework(BitcoinTestFramework):
         parser.add_option("--refbinary", dest="refbinary",
                           default=os.getenv("BITCOIND", "komodod"),
                           help="bitcoind binary to use for reference nodes (if any)")
+        parser.add_option("--pipeline-window", dest="pipeline_window", type="int", default=0,
+                          help="Stream blocks to the nodes, at most this many unrequested at a "
+                               "time, and only sync when an outcome must be checked (default: "
+                               "sync on every block)")
 
     def setup_chain(self):
         print "Initializing test directory "+self.options.tmpdir
@@ -185,24 +210,32 @@ class CryptoconditionsTestFramework(BitcoinTestFramework):
 
     def __init__(self):
         self.num_nodes = 2
+        self.from_snapshot = False
+
+    def add_options(self, parser):
+        parser.add_option("--funded-snapshot", dest="funded_snapshot", default=False, action="store_true",
+                          help="Start from the funded chain saved in --snapshotdir by an earlier "
+                               "test, or save it there once this test has funded it")
+        parser.add_option("--snapshotdir", dest="snapshotdir",
+                          default=os.path.join(tempfile.gettempdir(), "komodo-cc-funded"),
+                          help="Where --funded-snapshot keeps the funded datadirs (default: %default)")
 
     def setup_chain(self):
         print("Initializing CC test directory "+self.options.tmpdir)
-        initialize_chain_clean(self.options.tmpdir, self.num_nodes)
+        if self.options.funded_snapshot and self.have_funded_snapshot():
+            print("Starting from the funded snapshot in "+self.options.snapshotdir)
+            for i in range(self.num_nodes):
+                materialize_datadir(os.path.join(self.options.snapshotdir, "node"+str(i)),
+                                    os.path.join(self.options.tmpdir, "node"+str(i)))
+            self.from_snapshot = True
+        else:
+            initialize_chain_clean(self.options.tmpdir, self.num_nodes)
 
-    def setup_network(self, split = False):
-        print("Setting up network...")
-        self.addr    = "RWPg8B91kfK5UtUN7z6s6TeV9cHSGtVY8D"
-        self.pubkey  = "02676d00110c2cd14ae24f95969e8598f7ccfaa675498b82654a5b5bd57fc1d8cf"
-        self.privkey = "UqMgxk7ySPNQ4r9nKAFPjkXy6r5t898yhuNCjSZJLg3RAM4WW1m9"
-        self.addr1    = "RXEXoa1nRmKhMbuZovpcYwQMsicwzccZBp"
-        self.pubkey1  = "024026d4ad4ecfc1f705a9b42ca64af6d2ad947509c085534a30b8861d756c6ff0"
-        self.privkey1 = "UtdydP56pGTFmawHzHr1wDrc4oUwCNW1ttX8Pc3KrvH3MA8P49Wi"
-        self.nodes   = start_nodes(self.num_nodes, self.options.tmpdir,
-                    extra_args=[[
+    def node_args(self, root):
+        return [[
                     # always give -ac_name as first extra_arg and port as third
                     '-ac_name=REGTEST',
-                    '-conf='+self.options.tmpdir+'/node0/REGTEST.conf',
+                    '-conf='+root+'/node0/REGTEST.conf',
                     '-port=64367',
                     '-rpcport=64368',
                     '-regtest',
@@ -219,7 +252,7 @@ class CryptoconditionsTestFramework(BitcoinTestFramework):
                     '-rpcpassword=rt'
                     ],
                     ['-ac_name=REGTEST',
-                    '-conf='+self.options.tmpdir+'/node1/REGTEST.conf',
+                    '-conf='+root+'/node1/REGTEST.conf',
                     '-port=64365',
                     '-rpcport=64366',
                     '-regtest',
@@ -235,7 +268,17 @@ class CryptoconditionsTestFramework(BitcoinTestFramework):
                     '--daemon',
                     '-rpcuser=rt',
                     '-rpcpassword=rt']]
-        )
+
+    def setup_network(self, split = False):
+        print("Setting up network...")
+        self.addr    = "RWPg8B91kfK5UtUN7z6s6TeV9cHSGtVY8D"
+        self.pubkey  = "02676d00110c2cd14ae24f95969e8598f7ccfaa675498b82654a5b5bd57fc1d8cf"
+        self.privkey = "UqMgxk7ySPNQ4r9nKAFPjkXy6r5t898yhuNCjSZJLg3RAM4WW1m9"
+        self.addr1    = "RXEXoa1nRmKhMbuZovpcYwQMsicwzccZBp"
+        self.pubkey1  = "024026d4ad4ecfc1f705a9b42ca64af6d2ad947509c085534a30b8861d756c6ff0"
+        self.privkey1 = "UtdydP56pGTFmawHzHr1wDrc4oUwCNW1ttX8Pc3KrvH3MA8P49Wi"
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir,
+                                 extra_args=self.node_args(self.options.tmpdir))
         self.is_network_split = split
         self.rpc              = self.nodes[0]
         self.rpc1             = self.nodes[1]
@@ -249,3 +292,58 @@ class CryptoconditionsTestFramework(BitcoinTestFramework):
         rpc_connection.generate(1)
         return txid
 
+    def setup_funded_chain(self, always_mine=False):
+        """
+        Mine the 101 blocks that make the first coinbase spendable and
+        import the nodes' keys. With --funded-snapshot this is done once;
+        later tests start from the saved datadirs.
+
+        With --noshutdown the blocks are only mined if always_mine is
+        set: the first test of a run (faucet) funds the chain that the
+        following ones reuse.
+        """
+        if self.from_snapshot:
+            return
+        print("Mining blocks...")
+        rpc = self.nodes[0]
+        rpc1 = self.nodes[1]
+        # utxos from block 1 become mature in block 101
+        if always_mine or not self.options.noshutdown or self.options.funded_snapshot:
+            rpc.generate(101)
+        self.sync_all()
+        rpc.getinfo()
+        rpc1.getinfo()
+        # this corresponds to -pubkey above
+        print("Importing privkeys")
+        rpc.importprivkey(self.privkey)
+        rpc1.importprivkey(self.privkey1)
+        if self.options.funded_snapshot:
+            self.save_funded_snapshot()
+
+    # --funded-snapshot caches the datadirs of a funded chain, so that only
+    # the first CC test mines and imports keys. Each test still starts and
+    # stops its own daemons, from a copy of the snapshot in its tmpdir.
+
+    def have_funded_snapshot(self):
+        return os.path.isfile(os.path.join(self.options.snapshotdir, "funded"))
+
+    def save_funded_snapshot(self):
+        """Stop the nodes, copy their datadirs to --snapshotdir and restart them."""
+        urls = [ node.url for node in self.nodes ]
+        stop_nodes(self.nodes)
+        wait_bitcoinds()
+        # The daemons fork (--daemon), so wait for them to go away
+        for url in urls:
+            wait_rpc_down(url)
+        snapshotdir = self.options.snapshotdir
+        if os.path.isdir(snapshotdir):
+            shutil.rmtree(snapshotdir)
+        # Marked complete last, so an interrupted copy is never used
+        for i in range(self.num_nodes):
+            materialize_datadir(os.path.join(self.options.tmpdir, "node"+str(i)),
+                                os.path.join(snapshotdir, "node"+str(i)))
+        open(os.path.join(snapshotdir, "funded"), "w").close()
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir,
+                                 extra_args=self.node_args(self.options.tmpdir))
+        self.rpc = self.nodes[0]
+        self.rpc1 = self.nodes[1]
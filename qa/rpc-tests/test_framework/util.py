@@ -14,19 +14,35 @@ import sys
 from binascii import hexlify, unhexlify
 from base64 import b64encode
 from decimal import Decimal, ROUND_DOWN
+import hashlib
 import json
 import random
 import shutil
 import subprocess
+import threading
 import time
 import re
 
-from authproxy import AuthServiceProxy
+from authproxy import AuthServiceProxy, JSONRPCException
+
+# Highest number of nodes a test may start
+MAX_NODES = 8
+
+def port_offset():
+    """
+    Offset of this test's ports. Parallel test runners give every worker
+    its own PORT_SEED (0 to 123) so that concurrent tests never share a
+    port; otherwise it is derived from the pid.
+    """
+    seed = os.getenv("PORT_SEED")
+    if seed is not None:
+        return int(seed) * MAX_NODES
+    return os.getpid()%999
 
 def p2p_port(n):
-    return 11000 + n + os.getpid()%999
+    return 11000 + n + port_offset()
 def rpc_port(n):
-    return 12000 + n + os.getpid()%999
+    return 12000 + n + port_offset()
 
 def check_json_precision():
     """Make sure json library being used does not lose precision converting BTC values"""
@@ -44,17 +60,70 @@ def hex_str_to_bytes(hex_str):
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
 
+def run_parallel(func, args_list):
+    """
+    Call func(*args) for every args in args_list, each in its own
+    thread, and return the results in order. The first exception
+    raised by any call is re-raised once all calls have finished.
+    """
+    results = [None] * len(args_list)
+    errors = []
+    def run(i):
+        try:
+            results[i] = func(*args_list[i])
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [ threading.Thread(target=run, args=(i,)) for i in range(1, len(args_list)) ]
+    for t in threads:
+        t.start()
+    # Run the first call from this thread rather than idling
+    if args_list:
+        run(0)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def query_nodes(rpc_connections, method, *args):
+    """
+    Call method(*args) on every node concurrently and return the
+    results in node order
+    """
+    return run_parallel(lambda node: getattr(node, method)(*args),
+                        [ (node,) for node in rpc_connections ])
+
+MIN_POLL_INTERVAL = 0.01
+
+def poll_intervals(wait):
+    """
+    Sleep intervals for polling: start short and double up to wait,
+    which is at least MIN_POLL_INTERVAL so callers never spin on RPC
+    """
+    wait = max(wait, MIN_POLL_INTERVAL)
+    delay = min(0.05, wait)
+    while True:
+        yield delay
+        delay = min(delay * 2, wait)
+
+# When set, called as sync_observer(name, seconds) after every
+# sync_blocks/sync_mempools, e.g. by the --profile-rpc option of
+# BitcoinTestFramework.
+sync_observer = None
+
 def sync_blocks(rpc_connections, wait=1):
     """
     Wait until everybody has the same block count, and has notified
     all internal listeners of them
     """
-    while True:
-        counts = [ x.getblockcount() for x in rpc_connections ]
-        print counts
+    start = time.time()
+    for delay in poll_intervals(wait):
+        counts = query_nodes(rpc_connections, "getblockcount")
         if counts == [ counts[0] ]*len(counts):
             break
-        time.sleep(wait)
+        time.sleep(delay)
+    if sync_observer is not None:
+        sync_observer("sync_blocks", time.time() - start)
 
     # Now that the block counts are in sync, wait for the internal
     # notifications to finish
@@ -69,16 +138,18 @@ def sync_mempools(rpc_connections, wait=1):
     Wait until everybody has the same transactions in their memory
     pools, and has notified all internal listeners of them
     """
-    while True:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        print pool
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match = num_match+1
-        if num_match == len(rpc_connections):
-            break
-        time.sleep(wait)
+    start = time.time()
+    for delay in poll_intervals(wait):
+        # Cheap check first: mempools of different size can't match
+        infos = query_nodes(rpc_connections, "getmempoolinfo")
+        digests = [ (info['size'], info['bytes']) for info in infos ]
+        if digests == [ digests[0] ]*len(digests):
+            pools = [ set(pool) for pool in query_nodes(rpc_connections, "getrawmempool") ]
+            if pools == [ pools[0] ]*len(pools):
+                break
+        time.sleep(delay)
+    if sync_observer is not None:
+        sync_observer("sync_mempools", time.time() - start)
 
     # Now that the mempools are in sync, wait for the internal
     # notifications to finish
@@ -108,69 +179,139 @@ def initialize_datadir(dirname, n):
         f.write("timestampindex=1\n");
     return datadir
 
-def initialize_chain(test_dir):
+# Arguments every cached chain is built with
+CHAIN_ARGS = [
+    '-nuparams=5ba81b19:1', # Overwinter
+    '-nuparams=76b809bb:1', # Sapling
+]
+
+def chain_snapshot(num_nodes=4, extra_args=None):
     """
-    Create (or copy from cache) a 200-block-long chain and
-    4 wallets.
+    Return the cache directory holding a chain built by num_nodes
+    nodes started with extra_args, creating it if needed.
+    Each node mines 25 mature and 25 immature blocks, so the default
+    4 nodes give a 200-block-long chain.
     bitcoind and bitcoin-cli must be in search path.
     """
+    args = CHAIN_ARGS + (extra_args or [])
+    key = hashlib.sha256(repr((num_nodes, args))).hexdigest()[:16]
+    snapshot = os.path.join("cache", key)
+    if os.path.isdir(snapshot):
+        return snapshot
+
+    # Build next to the snapshot and rename it into place when done, so
+    # concurrent test runs never see a half-built cache
+    builddir = "%s.tmp%d" % (snapshot, os.getpid())
+    datadirs = []
+    for i in range(num_nodes):
+        datadir=initialize_datadir(builddir, i)
+        node_args = [ os.getenv("BITCOIND", "bitcoind"), "-keypool=1", "-datadir="+datadir, "-discover=0" ]
+        node_args.extend(args)
+        if i > 0:
+            node_args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
+        bitcoind_processes[i] = subprocess.Popen(node_args)
+        datadirs.append(datadir)
+    run_parallel(wait_for_rpc, [ (i, datadirs[i], None, os.getenv("BITCOINCLI", "bitcoin-cli"))
+                                 for i in range(num_nodes) ])
+    rpcs = []
+    for i in range(num_nodes):
+        try:
+            url = "http://rt:rt@127.0.0.1:%d"%(rpc_port(i),)
+            rpcs.append(AuthServiceProxy(url))
+        except:
+            sys.stderr.write("Error connecting to "+url+"\n")
+            sys.exit(1)
+
+    # blocks are created with timestamps 10 minutes apart, starting
+    # at 1 Jan 2014. Each peer mines its 25 blocks in one batch request
+    # of setmocktime/generate(1) pairs: generate(25) would pay every
+    # block to the same address, and sleeps a second per block while
+    # the clock is mocked. The other nodes' clocks are moved to the end
+    # of the batch first so they accept all its blocks.
+    block_time = 1388534400
+    for i in range(2):
+        for peer in range(num_nodes):
+            end_time = block_time + 24*10*60
+            set_node_times([ rpc for rpc in rpcs if rpc is not rpcs[peer] ], end_time)
+            b = rpcs[peer].batch()
+            for j in range(25):
+                b.setmocktime(block_time)
+                b.generate(1)
+                block_time += 10*60
+            b.results()
+            # Must sync before next peer starts generating blocks
+            sync_blocks(rpcs)
+
+    # Shut them down, and clean up cache directories:
+    stop_nodes(rpcs)
+    wait_bitcoinds()
+    for i in range(num_nodes):
+        os.remove(log_filename(builddir, i, "debug.log"))
+        os.remove(log_filename(builddir, i, "db.log"))
+        os.remove(log_filename(builddir, i, "peers.dat"))
+        os.remove(log_filename(builddir, i, "fee_estimates.dat"))
+    with open(os.path.join(builddir, "args"), "w") as f:
+        f.write("%d nodes: %s\n" % (num_nodes, " ".join(args)))
+    try:
+        os.rename(builddir, snapshot)
+    except OSError:
+        # Someone else built the same snapshot meanwhile
+        shutil.rmtree(builddir)
+    return snapshot
+
+# LevelDB table files are never modified once written, so test datadirs
+# can share them with the cache. Everything else (block files, wallet,
+# LevelDB logs and manifests) is written in place and must be copied.
+SHARED_FILE_SUFFIXES = ('.ldb', '.sst')
+
+# ioctl to share a file's extents with another file (Linux btrfs, xfs, ...)
+FICLONE = 0x40049409
 
-    if not os.path.isdir(os.path.join("cache", "node0")):
-        devnull = open("/dev/null", "w+")
-        # Create cache directories, run bitcoinds:
-        for i in range(4):
-            datadir=initialize_datadir("cache", i)
-            args = [ os.getenv("BITCOIND", "bitcoind"), "-keypool=1", "-datadir="+datadir, "-discover=0" ]
-            args.extend([
-                '-nuparams=5ba81b19:1', # Overwinter
-                '-nuparams=76b809bb:1', # Sapling
-            ])
-            if i > 0:
-                args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
-            bitcoind_processes[i] = subprocess.Popen(args)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print "initialize_chain: bitcoind started, calling bitcoin-cli -rpcwait getblockcount"
-            subprocess.check_call([ os.getenv("BITCOINCLI", "bitcoin-cli"), "-datadir="+datadir,
-                                    "-rpcwait", "getblockcount"], stdout=devnull)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print "initialize_chain: bitcoin-cli -rpcwait getblockcount completed"
-        devnull.close()
-        rpcs = []
-        for i in range(4):
-            try:
-                url = "http://rt:rt@127.0.0.1:%d"%(rpc_port(i),)
-                rpcs.append(AuthServiceProxy(url))
-            except:
-                sys.stderr.write("Error connecting to "+url+"\n")
-                sys.exit(1)
-
-        # Create a 200-block-long chain; each of the 4 nodes
-        # gets 25 mature blocks and 25 immature.
-        # blocks are created with timestamps 10 minutes apart, starting
-        # at 1 Jan 2014
-        block_time = 1388534400
-        for i in range(2):
-            for peer in range(4):
-                for j in range(25):
-                    set_node_times(rpcs, block_time)
-                    rpcs[peer].generate(1)
-                    block_time += 10*60
-                # Must sync before next peer starts generating blocks
-                sync_blocks(rpcs)
-
-        # Shut them down, and clean up cache directories:
-        stop_nodes(rpcs)
-        wait_bitcoinds()
-        for i in range(4):
-            os.remove(log_filename("cache", i, "debug.log"))
-            os.remove(log_filename("cache", i, "db.log"))
-            os.remove(log_filename("cache", i, "peers.dat"))
-            os.remove(log_filename("cache", i, "fee_estimates.dat"))
-
-    for i in range(4):
-        from_dir = os.path.join("cache", "node"+str(i))
+def clone_file(src, dst):
+    """
+    Copy src to dst, as a copy-on-write clone where the filesystem
+    supports it
+    """
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, IOError, OSError):
+        shutil.copy2(src, dst)
+
+def materialize_datadir(from_dir, to_dir):
+    """
+    Populate to_dir from a cached datadir, hardlinking the files that
+    are never modified and cloning the rest
+    """
+    for (root, dirs, files) in os.walk(from_dir):
+        target = os.path.join(to_dir, os.path.relpath(root, from_dir))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target, name)
+            if name.endswith(SHARED_FILE_SUFFIXES):
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    pass
+            clone_file(src, dst)
+
+def initialize_chain(test_dir, num_nodes=4, extra_args=None):
+    """
+    Create (from the cached snapshot for these parameters) a chain
+    and num_nodes wallets, 200 blocks long with the default 4 nodes.
+    bitcoind and bitcoin-cli must be in search path.
+    """
+    snapshot = chain_snapshot(num_nodes, extra_args)
+    for i in range(num_nodes):
+        from_dir = os.path.join(snapshot, "node"+str(i))
         to_dir = os.path.join(test_dir,  "node"+str(i))
-        shutil.copytree(from_dir, to_dir)
+        materialize_datadir(from_dir, to_dir)
         initialize_datadir(test_dir, i) # Overwrite port/rpcport in zcash.conf
 
 def initialize_chain_clean(test_dir, num_nodes):
@@ -202,9 +343,69 @@ def _rpchost_to_args(rpchost):
         rv += ['-rpcport=' + rpcport]
     return rv
 
-def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+# Seconds to wait for a freshly started node to answer RPC
+RPC_WAIT_TIMEOUT = 600
+
+def log_tail(datadir, lines=20):
     """
-    Start a bitcoind and return RPC connection to it
+    Return the last lines of every debug.log under datadir
+    """
+    tails = []
+    for (root, dirs, files) in os.walk(datadir):
+        if "debug.log" in files:
+            with open(os.path.join(root, "debug.log")) as f:
+                tail = f.readlines()[-lines:]
+            tails.append("==> %s <==\n%s" % (os.path.join(root, "debug.log"), "".join(tail)))
+    return "\n".join(tails)
+
+def wait_for_rpc(i, datadir, rpchost=None, cli=None, timeout=RPC_WAIT_TIMEOUT):
+    """
+    Wait until node i answers RPC, at most timeout seconds.
+    Raises RuntimeError, with the tail of its debug.log, if the node
+    exits with an error or doesn't come up in time.
+    """
+    if cli is None:
+        cli = os.getenv("BITCOINCLI", "komodo-cli")
+    start = time.time()
+    devnull = open("/dev/null", "w+")
+    if os.getenv("PYTHON_DEBUG", ""):
+        print "wait_for_rpc: calling bitcoin-cli -rpcwait getblockcount for node %d" % i
+    rpcwait = subprocess.Popen([ cli, "-datadir="+datadir] + _rpchost_to_args(rpchost) +
+                               ["-rpcwait", "getblockcount"], stdout=devnull)
+    error = None
+    for delay in poll_intervals(0.5):
+        if rpcwait.poll() is not None:
+            if rpcwait.returncode != 0:
+                error = "bitcoin-cli exited with code %d" % rpcwait.returncode
+            break
+        # bitcoind exits early (with code 0) when started with -daemon
+        if bitcoind_processes[i].poll():
+            error = "bitcoind exited with code %d" % bitcoind_processes[i].returncode
+            break
+        if time.time() - start > timeout:
+            error = "RPC not ready after %d seconds" % timeout
+            break
+        time.sleep(delay)
+    devnull.close()
+    if error is not None:
+        if rpcwait.returncode is None:
+            rpcwait.kill()
+            rpcwait.wait()
+        raise RuntimeError("node %d failed to start: %s\n%s" % (i, error, log_tail(datadir)))
+    sys.stdout.write("node %d ready after %.1fs\n" % (i, time.time() - start))
+
+def _node_proxy(i, rpchost=None, timewait=None):
+    url = "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
+    if timewait is not None:
+        proxy = AuthServiceProxy(url, timeout=timewait)
+    else:
+        proxy = AuthServiceProxy(url)
+    proxy.url = url # store URL on proxy for info
+    return proxy
+
+def launch_node(i, dirname, extra_args=None, binary=None):
+    """
+    Start a bitcoind without waiting for it, return its datadir
     """
     datadir = os.path.join(dirname, "node"+str(i))
         # creating special config in case of cryptocondition asset chain test
@@ -234,30 +435,26 @@ def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=
     if extra_args is not None: args.extend(extra_args)
     print(args)
     bitcoind_processes[i] = subprocess.Popen(args)
-    devnull = open("/dev/null", "w+")
-    if os.getenv("PYTHON_DEBUG", ""):
-        print "start_node: bitcoind started, calling bitcoin-cli -rpcwait getblockcount"
-    subprocess.check_call([ os.getenv("BITCOINCLI", "komodo-cli"), "-datadir="+datadir] +
-                          _rpchost_to_args(rpchost)  +
-                          ["-rpcwait", "getblockcount"], stdout=devnull)
-    if os.getenv("PYTHON_DEBUG", ""):
-        print "start_node: calling bitcoin-cli -rpcwait getblockcount returned"
-    devnull.close()
-    url = "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
-    if timewait is not None:
-        proxy = AuthServiceProxy(url, timeout=timewait)
-    else:
-        proxy = AuthServiceProxy(url)
-    proxy.url = url # store URL on proxy for info
-    return proxy
+    return datadir
+
+def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+    """
+    Start a bitcoind and return RPC connection to it
+    """
+    datadir = launch_node(i, dirname, extra_args, binary)
+    wait_for_rpc(i, datadir, rpchost)
+    return _node_proxy(i, rpchost, timewait)
 
 def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, binary=None):
     """
-    Start multiple bitcoinds, return RPC connections to them
+    Start multiple bitcoinds, return RPC connections to them.
+    All processes are spawned first, then waited for concurrently.
     """
     if extra_args is None: extra_args = [ None for i in range(num_nodes) ]
     if binary is None: binary = [ None for i in range(num_nodes) ]
-    return [ start_node(i, dirname, extra_args[i], rpchost, binary=binary[i]) for i in range(num_nodes) ]
+    datadirs = [ launch_node(i, dirname, extra_args[i], binary[i]) for i in range(num_nodes) ]
+    run_parallel(wait_for_rpc, [ (i, datadirs[i], rpchost) for i in range(num_nodes) ])
+    return [ _node_proxy(i, rpchost) for i in range(num_nodes) ]
 
 def log_filename(dirname, n_node, logname):
     return os.path.join(dirname, "node"+str(n_node), "regtest", logname)
@@ -268,13 +465,30 @@ def check_node(i):
 
 def stop_node(node, i):
     node.stop()
+    node._close()
     bitcoind_processes[i].wait()
     del bitcoind_processes[i]
 
 def stop_nodes(nodes):
+    query_nodes(nodes, "stop")
     for node in nodes:
-        node.stop()
-    del nodes[:] # Emptying array closes connections as a side effect
+        node._close()
+    del nodes[:]
+
+def generate_blocks(node, count, sync_with=None):
+    """
+    Mine count blocks on node and return their hashes, then wait once
+    for the nodes in sync_with (if any) to have them.
+    The blocks are mined by generate(1) calls sent in one JSON-RPC batch
+    request: komodod's generate(N) sleeps a second between blocks.
+    """
+    b = node.batch()
+    for i in range(count):
+        b.generate(1)
+    hashes = [ result[0] for result in b.results() ]
+    if sync_with:
+        sync_blocks(sync_with)
+    return hashes
 
 def set_node_times(nodes, t):
     for node in nodes:
@@ -282,10 +496,33 @@ def set_node_times(nodes, t):
 
 def wait_bitcoinds():
     # Wait for all bitcoinds to cleanly exit
-    for bitcoind in bitcoind_processes.values():
+    start = time.time()
+    def wait(i, bitcoind):
         bitcoind.wait()
+        sys.stdout.write("node %d stopped after %.1fs\n" % (i, time.time() - start))
+    run_parallel(wait, sorted(bitcoind_processes.items()))
     bitcoind_processes.clear()
 
+def wait_rpc_down(url, timeout=RPC_WAIT_TIMEOUT):
+    """
+    Wait until nothing answers RPC at url. Needed for nodes started with
+    --daemon, which fork and are not waited for by wait_bitcoinds.
+    """
+    proxy = AuthServiceProxy(url, timeout=10)
+    deadline = time.time() + timeout
+    for delay in poll_intervals(1):
+        try:
+            proxy.getblockcount()
+        except JSONRPCException:
+            # Still shutting down
+            pass
+        except Exception:
+            proxy._close()
+            return
+        if time.time() > deadline:
+            raise RuntimeError("node at %s did not stop within %ds" % (url, timeout))
+        time.sleep(delay)
+
 def connect_nodes(from_connection, node_num):
     ip_port = "127.0.0.1:"+str(p2p_port(node_num))
     from_connection.addnode(ip_port, "onetry")
@@ -5,12 +5,11 @@
 #
 # Common code for testing transaction expiry
 #
-from test_framework.mininode import CTransaction, NodeConnCB, mininode_lock, msg_ping, \
+from test_framework.mininode import CTransaction, NodeConnCB, msg_ping, \
     msg_pong
 from test_framework.util import fail
 
 import cStringIO
-import time
 
 from binascii import hexlify, unhexlify
 
@@ -26,17 +25,6 @@ class TestNode(NodeConnCB):
     def add_connection(self, conn):
         self.connection = conn
 
-    # Spin until verack message is received from the node.
-    # We use this to signal that our test can begin. This
-    # is called from the testing thread, so it needs to acquire
-    # the global lock.
-    def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
-
     # Wrapper for the NodeConn's send_message function
     def send_message(self, message):
         self.connection.send_message(message)
@@ -67,15 +55,9 @@ class TestNode(NodeConnCB):
     # Sync up with the node after delivery of a message
     def sync_with_ping(self, timeout=30):
         self.connection.send_message(msg_ping(nonce=self.ping_counter))
-        sleep_time = 0.05
-        while timeout > 0:
-            with mininode_lock:
-                if self.last_pong.nonce == self.ping_counter:
-                    self.ping_counter += 1
-                    return
-            time.sleep(sleep_time)
-            timeout -= sleep_time
-        fail("Should have received pong")
+        if not self.wait_for_pong(self.ping_counter, timeout):
+            fail("Should have received pong")
+        self.ping_counter += 1
 
 
 def create_transaction(node, coinbase, to_address, amount, expiry_height):